@@ -4,6 +4,7 @@ from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_save
 from divesites.models import Divesite, Compressor, Slipway
+from dsapi import conditional
 
 # Create your models here.
 class Comment(models.Model):
@@ -43,3 +44,8 @@ def send_compressor_comment_creation_action(sender, instance, created, **kwargs)
         verb = 'commented'
         action.send(instance.owner, verb=verb, action_object=instance, target=instance.compressor)
 post_save.connect(send_compressor_comment_creation_action, sender=CompressorComment)
+
+# Keep version stamps for conditional GETs (see dsapi.conditional)
+conditional.track(CompressorComment, 'compressor')
+conditional.track(DivesiteComment, 'divesite')
+conditional.track(SlipwayComment, 'slipway')
@@ -4,11 +4,12 @@ from rest_framework import mixins, viewsets
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from divesites.models import Divesite, Compressor, Slipway
 from divesites.permissions import IsOwnerOrReadOnly
+from dsapi.conditional import PROFILE_TAGS, ConditionalGetMixin
 from .models import DivesiteComment, SlipwayComment, CompressorComment
 from .serializers import DivesiteCommentSerializer, SlipwayCommentSerializer, CompressorCommentSerializer
 
 # Viewsets for comments.
-class CompressorCommentViewSet(viewsets.GenericViewSet,
+class CompressorCommentViewSet(ConditionalGetMixin, viewsets.GenericViewSet,
         mixins.CreateModelMixin,
         mixins.RetrieveModelMixin,
         mixins.UpdateModelMixin,
@@ -17,6 +18,7 @@ class CompressorCommentViewSet(viewsets.GenericViewSet,
     permission_classes = (IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly,)
     queryset = CompressorComment.objects.all()
     serializer_class = CompressorCommentSerializer
+    version_tags = {'retrieve': ('comments.compressorcomment:{pk}',) + PROFILE_TAGS}
 
     def perform_create(self, serializer):
         user = self.request.user
@@ -26,7 +28,7 @@ class CompressorCommentViewSet(viewsets.GenericViewSet,
         instance = serializer.save(owner=user, compressor=compressor)
 
 
-class DivesiteCommentViewSet(viewsets.GenericViewSet,
+class DivesiteCommentViewSet(ConditionalGetMixin, viewsets.GenericViewSet,
         mixins.CreateModelMixin,
         mixins.RetrieveModelMixin,
         mixins.UpdateModelMixin,
@@ -35,6 +37,7 @@ class DivesiteCommentViewSet(viewsets.GenericViewSet,
     permission_classes = (IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly,)
     queryset = DivesiteComment.objects.all()
     serializer_class = DivesiteCommentSerializer
+    version_tags = {'retrieve': ('comments.divesitecomment:{pk}',) + PROFILE_TAGS}
 
     def perform_create(self, serializer):
         user = self.request.user
@@ -44,7 +47,7 @@ class DivesiteCommentViewSet(viewsets.GenericViewSet,
         instance = serializer.save(owner=self.request.user, divesite=divesite)
 
 
-class SlipwayCommentViewSet(viewsets.GenericViewSet,
+class SlipwayCommentViewSet(ConditionalGetMixin, viewsets.GenericViewSet,
         mixins.CreateModelMixin,
         mixins.RetrieveModelMixin,
         mixins.UpdateModelMixin,
@@ -53,6 +56,7 @@ class SlipwayCommentViewSet(viewsets.GenericViewSet,
     permission_classes = (IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly,)
     queryset = SlipwayComment.objects.all()
     serializer_class = SlipwayCommentSerializer
+    version_tags = {'retrieve': ('comments.slipwaycomment:{pk}',) + PROFILE_TAGS}
 
     def perform_create(self, serializer):
         user=self.request.user
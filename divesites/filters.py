@@ -0,0 +1,54 @@
+from decimal import Decimal, InvalidOperation
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+
+class BoundingBoxFilter(BaseFilterBackend):
+    """
+    Restrict a site queryset to ?bbox=minlng,minlat,maxlng,maxlat. A box
+    whose minimum longitude is greater than its maximum crosses the
+    antimeridian.
+    """
+    bbox_param = 'bbox'
+
+    def get_bounding_box(self, request):
+        bbox = request.query_params.get(self.bbox_param)
+        if not bbox:
+            return None
+        try:
+            min_lng, min_lat, max_lng, max_lat = [Decimal(_) for _ in bbox.split(',')]
+        except (ValueError, InvalidOperation):
+            raise ValidationError({self.bbox_param: 'Expected minlng,minlat,maxlng,maxlat'})
+        if not (-180 <= min_lng <= 180 and -180 <= max_lng <= 180):
+            raise ValidationError({self.bbox_param: 'Longitudes must be between -180 and 180'})
+        if not -90 <= min_lat <= max_lat <= 90:
+            raise ValidationError({self.bbox_param: 'Latitudes must be between -90 and 90, minimum first'})
+        return min_lng, min_lat, max_lng, max_lat
+
+    def filter_queryset(self, request, queryset, view):
+        bbox = self.get_bounding_box(request)
+        if bbox is None:
+            return queryset
+        min_lng, min_lat, max_lng, max_lat = bbox
+        # Latitude leads the (latitude, longitude) index on the site tables
+        queryset = queryset.filter(latitude__gte=min_lat, latitude__lte=max_lat)
+        if min_lng <= max_lng:
+            return queryset.filter(longitude__gte=min_lng, longitude__lte=max_lng)
+        return queryset.filter(Q(longitude__gte=min_lng) | Q(longitude__lte=max_lng))
+
+
+class RegionFilter(BaseFilterBackend):
+    """
+    Restrict a site queryset to a ?country= (ISO 3166 code) and/or a
+    ?region= (first-level administrative area, e.g. a state or county).
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        country = request.query_params.get('country')
+        if country:
+            queryset = queryset.filter(country=country.upper())
+        region = request.query_params.get('region')
+        if region:
+            queryset = queryset.filter(admin_area_1__iexact=region)
+        return queryset
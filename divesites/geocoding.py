@@ -0,0 +1,333 @@
+"""
+Reverse geocoding of site positions.
+
+Looking a position up with Google's reverse-geocoding API means a network
+round trip, so we don't do it while a request waits. Saving a site
+schedules a geocoding job instead; once the transaction commits, the job
+runs on a small thread pool and writes the result back to the site's
+geocoding_data.
+
+Sites close to one another share geocoding results: responses are cached
+in the GeocodingResult table, keyed on the position rounded to
+GEOCODING_CACHE_PRECISION decimal places, with an in-memory LRU cache in
+front of it.
+"""
+import json
+import logging
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def fetch_geocoding_data(lat, lng):
+    """
+    Contact the Google reverse-geocoding API to retrieve geocoding data
+    for this lat/lng pair, raising an exception if we can't.
+    """
+    url = settings.GOOGLE_REVERSE_GEOCODING_URL_STRING_TEMPLATE % (lat, lng)
+    response = urllib.request.urlopen(url, timeout=settings.GEOCODING_TIMEOUT)
+    return response.read().decode('utf-8')
+
+
+def retrieve_geocoding_data(lat, lng):
+    """
+    Retrieve geocoding data for this lat/lng pair, or return None if the
+    geocoder can't be reached.
+    """
+    try:
+        return fetch_geocoding_data(lat, lng)
+    except Exception:
+        # We might get a URLError, HTTPError or timeout, but there's really
+        # nothing we can do about it except log it
+        logger.warning('Reverse geocoding failed for %s,%s', lat, lng, exc_info=True)
+        return None
+
+
+# Site fields filled in from Google address components, and the component
+# types they come from
+ADDRESS_COMPONENT_FIELDS = (
+        ('country', 'country'),
+        ('admin_area_1', 'administrative_area_level_1'),
+        ('locality', 'locality'),
+        )
+# All of the site fields filled in from geocoding data
+GEOCODED_FIELDS = tuple(field for field, _ in ADDRESS_COMPONENT_FIELDS) + ('formatted_address',)
+
+
+def parse_geocoding_data(geocoding_data):
+    """
+    Pull the country (as an ISO 3166 code), first-level administrative
+    area, locality and formatted address out of a reverse-geocoding
+    response, returning a dict of site field values (blank if not found).
+    """
+    fields = dict((field, '') for field in GEOCODED_FIELDS)
+    try:
+        results = json.loads(geocoding_data).get('results') or []
+    except (ValueError, AttributeError):
+        return fields
+    if results:
+        fields['formatted_address'] = (results[0].get('formatted_address') or '')[:500]
+    # Results run from most to least specific; take the first match for each
+    for field, component_type in ADDRESS_COMPONENT_FIELDS:
+        for result in results:
+            components = [c for c in result.get('address_components', []) if component_type in c.get('types', [])]
+            if components:
+                name = components[0].get('short_name' if field == 'country' else 'long_name') or ''
+                fields[field] = name[:2] if field == 'country' else name[:200]
+                break
+    return fields
+
+
+def set_geocoding_data(site, geocoding_data):
+    """
+    Set geocoding_data on a site along with the fields parsed out of it,
+    returning the names of the fields that have changed.
+    """
+    site.geocoding_data = geocoding_data
+    fields = parse_geocoding_data(geocoding_data)
+    for field, value in fields.items():
+        setattr(site, field, value)
+    return ['geocoding_data'] + sorted(fields.keys())
+
+
+def is_cacheable(geocoding_data):
+    # Google reports errors (e.g., OVER_QUERY_LIMIT) in a 200 response, and
+    # we don't want to hang on to those
+    try:
+        return json.loads(geocoding_data).get('status') in ('OK', 'ZERO_RESULTS')
+    except (ValueError, AttributeError):
+        return False
+
+
+class GeocodingCache(object):
+    """
+    A two-level cache of geocoding responses, keyed on quantized
+    positions: an in-process LRU cache in front of the GeocodingResult
+    table. Entries older than GEOCODING_CACHE_TTL seconds are refetched.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, lat, lng):
+        precision = settings.GEOCODING_CACHE_PRECISION
+        # Keys are stored in GeocodingResult, which can't hold any more
+        # decimal places than its fields have
+        decimal_places = apps.get_model('divesites', 'GeocodingResult')._meta.get_field('latitude').decimal_places
+        if not 0 <= precision <= decimal_places:
+            raise ImproperlyConfigured(
+                    'GEOCODING_CACHE_PRECISION must be between 0 and %d' % decimal_places)
+        quantum = Decimal(1).scaleb(-precision)
+        return (Decimal(str(lat)).quantize(quantum), Decimal(str(lng)).quantize(quantum))
+
+    def _is_fresh(self, retrieval_date):
+        return timezone.now() - retrieval_date < timedelta(seconds=settings.GEOCODING_CACHE_TTL)
+
+    def _remember(self, key, geocoding_data, retrieval_date):
+        with self._lock:
+            self._entries[key] = (geocoding_data, retrieval_date)
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.GEOCODING_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._is_fresh(entry[1]):
+                    self._entries.move_to_end(key)
+                    return entry[0]
+                del self._entries[key]
+        GeocodingResult = apps.get_model('divesites', 'GeocodingResult')
+        try:
+            result = GeocodingResult.objects.get(latitude=key[0], longitude=key[1])
+        except GeocodingResult.DoesNotExist:
+            return None
+        if not self._is_fresh(result.retrieval_date):
+            return None
+        self._remember(key, result.geocoding_data, result.retrieval_date)
+        return result.geocoding_data
+
+    def _set(self, key, geocoding_data):
+        GeocodingResult = apps.get_model('divesites', 'GeocodingResult')
+        retrieval_date = timezone.now()
+        GeocodingResult.objects.update_or_create(
+                latitude=key[0], longitude=key[1],
+                defaults={'geocoding_data': geocoding_data, 'retrieval_date': retrieval_date})
+        self._remember(key, geocoding_data, retrieval_date)
+
+    def get(self, lat, lng):
+        """Return cached geocoding data for this lat/lng pair, or None."""
+        geocoding_data = self._get(self.key(lat, lng))
+        # Geocoding jobs look things up from several threads at once
+        with self._lock:
+            if geocoding_data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return geocoding_data
+
+    def get_many(self, positions):
+        """
+        Return a dict of each of the lat/lng pairs in positions that has
+        cached geocoding data to that data. Whatever isn't in memory is
+        looked up in a single query.
+        """
+        keys = dict((position, self.key(*position)) for position in positions)
+        found = {}
+        with self._lock:
+            for position, key in keys.items():
+                entry = self._entries.get(key)
+                if entry is not None and self._is_fresh(entry[1]):
+                    found[position] = entry[0]
+        missing = set(key for position, key in keys.items() if position not in found)
+        if missing:
+            GeocodingResult = apps.get_model('divesites', 'GeocodingResult')
+            cutoff = timezone.now() - timedelta(seconds=settings.GEOCODING_CACHE_TTL)
+            query = Q()
+            for latitude, longitude in missing:
+                query |= Q(latitude=latitude, longitude=longitude)
+            results = {}
+            for result in GeocodingResult.objects.filter(query, retrieval_date__gt=cutoff):
+                key = (result.latitude, result.longitude)
+                self._remember(key, result.geocoding_data, result.retrieval_date)
+                results[key] = result.geocoding_data
+            for position, key in keys.items():
+                if key in results:
+                    found[position] = results[key]
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, lat, lng, geocoding_data):
+        """Cache geocoding data for this lat/lng pair, unless it's an error."""
+        if geocoding_data and is_cacheable(geocoding_data):
+            self._set(self.key(lat, lng), geocoding_data)
+
+    def get_or_fetch(self, lat, lng, fetch=retrieve_geocoding_data):
+        """
+        Return geocoding data for this lat/lng pair from the cache, or
+        else from fetch(lat, lng), caching the result.
+        """
+        geocoding_data = self.get(lat, lng)
+        if geocoding_data is None:
+            geocoding_data = fetch(lat, lng)
+            self.set(lat, lng, geocoding_data)
+        return geocoding_data
+
+    def clear(self):
+        """Forget the in-memory entries (but not the table) and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+geocoding_cache = GeocodingCache()
+
+
+class TokenBucket(object):
+    """
+    Rate limiter allowing `rate` calls per second on average, in bursts
+    of up to `capacity` calls.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a call is allowed."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def same_position(a, b):
+    # Positions come back from the DB as Decimals but might have been set
+    # as floats, so compare them as floats
+    return all(abs(float(x) - float(y)) < 1e-9 for x, y in zip(a, b))
+
+
+class GeocodingQueue(object):
+    """Runs geocoding jobs for saved sites on a background thread pool."""
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=settings.GEOCODING_WORKERS)
+            return self._executor
+
+    def schedule(self, site, update_fields=None):
+        """
+        Geocode site after the current transaction commits, unless it's
+        only being saved to update fields other than its position.
+        """
+        if update_fields is not None and not {'latitude', 'longitude'} & set(update_fields):
+            return
+        job = (site._meta.label, site.pk, site.latitude, site.longitude)
+        if settings.GEOCODING_SYNCHRONOUS:
+            self.process(*job)
+        else:
+            transaction.on_commit(lambda: self.executor.submit(self.run, *job))
+
+    def run(self, *job):
+        # Worker threads get a DB connection of their own; don't leave it open
+        try:
+            self.process(*job)
+        except Exception:
+            logger.exception('Geocoding job %s failed', job)
+        finally:
+            connection.close()
+
+    def process(self, label, pk, latitude, longitude):
+        geocoding_data = geocoding_cache.get_or_fetch(latitude, longitude)
+        if not geocoding_data:
+            return
+        model = apps.get_model(label)
+        try:
+            site = model.objects.no_cache().get(pk=pk)
+        except model.DoesNotExist:
+            return
+        # If the site has moved since this job was scheduled, then there's
+        # another job on the way with the right data
+        if not same_position((site.latitude, site.longitude), (latitude, longitude)):
+            return
+        site.save(update_fields=set_geocoding_data(site, geocoding_data))
+
+
+geocoding_queue = GeocodingQueue()
@@ -0,0 +1,133 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.core.management.base import BaseCommand, CommandError
+from divesites.geocoding import (TokenBucket, fetch_geocoding_data, geocoding_cache,
+        is_cacheable, set_geocoding_data)
+from divesites.models import Compressor, Divesite, Slipway
+
+SITE_MODELS = (Compressor, Divesite, Slipway)
+
+
+class GeocoderError(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Fill in missing, failed or stale geocoding data for compressors, '
+            'divesites and slipways, using a rate-limited pool of threads')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                help='Number of concurrent requests to the geocoder')
+        parser.add_argument('--rate', type=float, default=10,
+                help='Maximum requests per second to the geocoder')
+        parser.add_argument('--retries', type=int, default=3,
+                help='Times to retry a failed request, backing off exponentially')
+        parser.add_argument('--backoff', type=float, default=1,
+                help='Seconds to wait before the first retry')
+        parser.add_argument('--batch-size', type=int, default=100,
+                help='Number of sites to work on between checkpoints')
+        parser.add_argument('--checkpoint',
+                help='File recording progress; an interrupted run can be resumed from it')
+
+    def handle(self, *args, **options):
+        self.options = options
+        if options['workers'] < 1 or options['rate'] <= 0 or options['batch_size'] < 1:
+            raise CommandError('--workers, --rate and --batch-size must be positive')
+        if options['retries'] < 0 or options['backoff'] < 0:
+            raise CommandError('--retries and --backoff must not be negative')
+        self.bucket = TokenBucket(options['rate'], capacity=options['workers'])
+        self.checkpoint = self.load_checkpoint()
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            for model in SITE_MODELS:
+                self.backfill(model, executor)
+
+    def load_checkpoint(self):
+        path = self.options['checkpoint']
+        if path and os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+        return {}
+
+    def save_checkpoint(self):
+        path = self.options['checkpoint']
+        if path:
+            # Write to a temporary file first, so that an interruption
+            # can't leave a half-written checkpoint behind
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.checkpoint, f)
+            os.replace(path + '.tmp', path)
+
+    def fetch(self, lat, lng):
+        """Fetch geocoding data, retrying with exponential backoff."""
+        delay = self.options['backoff']
+        for attempt in range(self.options['retries'] + 1):
+            self.bucket.acquire()
+            try:
+                geocoding_data = fetch_geocoding_data(lat, lng)
+                if is_cacheable(geocoding_data):
+                    return geocoding_data
+                error = GeocoderError(geocoding_data[:200])
+            except Exception as e:
+                error = e
+            if attempt < self.options['retries']:
+                time.sleep(delay)
+                delay *= 2
+        raise error
+
+    def backfill(self, model, executor):
+        """
+        Bring every site of model up to date with the geocoding cache,
+        fetching anything it hasn't got a fresh (younger than
+        GEOCODING_CACHE_TTL) result for. That covers sites whose data is
+        missing or failed as well as stale. Sites are walked in
+        primary-key order, a batch at a time.
+        """
+        label = model._meta.label
+        queryset = model.objects.no_cache().order_by('pk')
+        if label in self.checkpoint:
+            queryset = queryset.filter(pk__gt=self.checkpoint[label])
+        total = queryset.count()
+        checked = geocoded = failed = 0
+        # The checkpoint stops short of the first site that couldn't be
+        # geocoded, so that a resumed run tries it again
+        stalled = False
+        self.stdout.write('%s: %d sites to check' % (label, total))
+        while True:
+            sites = list(queryset[:self.options['batch_size']])
+            if not sites:
+                break
+            cached = geocoding_cache.get_many(set((site.latitude, site.longitude) for site in sites))
+            futures = {}
+            for site in sites:
+                geocoding_data = cached.get((site.latitude, site.longitude))
+                if geocoding_data is None:
+                    futures[executor.submit(self.fetch, site.latitude, site.longitude)] = site
+                elif geocoding_data != site.geocoding_data:
+                    site.save(update_fields=set_geocoding_data(site, geocoding_data))
+                    geocoded += 1
+            # Workers only talk to the geocoder; the DB is written to from here
+            failures = set()
+            for future in as_completed(futures):
+                site = futures[future]
+                try:
+                    geocoding_data = future.result()
+                except Exception as e:
+                    failures.add(site.pk)
+                    self.stderr.write('%s %s: %s' % (label, site.pk, e))
+                    continue
+                geocoding_cache.set(site.latitude, site.longitude, geocoding_data)
+                site.save(update_fields=set_geocoding_data(site, geocoding_data))
+                geocoded += 1
+            checked += len(sites)
+            failed += len(failures)
+            for site in sites:
+                stalled = stalled or site.pk in failures
+                if stalled:
+                    break
+                self.checkpoint[label] = str(site.pk)
+            self.save_checkpoint()
+            queryset = queryset.filter(pk__gt=sites[-1].pk)
+            self.stdout.write('%s: %d/%d checked, %d geocoded, %d failed' % (label, checked, total, geocoded, failed))
@@ -0,0 +1,33 @@
+import time
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIRequestFactory
+from divesites.views import DivesiteViewSet
+
+
+class Command(BaseCommand):
+    help = 'Time the full divesite list against the clustered list at some zoom levels'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5,
+                help='Number of requests to make to each endpoint')
+        parser.add_argument('--zoom', type=int, nargs='+', default=[2, 6, 10],
+                help='Zoom levels to request clusters for')
+
+    def handle(self, *args, **options):
+        factory = APIRequestFactory()
+        endpoints = [('list', DivesiteViewSet.as_view({'get': 'list'}), '/divesites/')]
+        for zoom in options['zoom']:
+            endpoints.append((
+                'zoom %d' % zoom,
+                DivesiteViewSet.as_view({'get': 'clusters'}),
+                '/divesites/clusters/?zoom=%d' % zoom,
+                ))
+        for name, view, url in endpoints:
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.time()
+                response = view(factory.get(url))
+                response.render()
+                timings.append(time.time() - start)
+            self.stdout.write('%-8s %9.1f ms (best of %d) %10d bytes' % (
+                name, min(timings) * 1000, options['repeat'], len(response.content)))
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2016-10-18 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('divesites', '0023_dive_average_depth'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='compressor',
+            index_together=set([('latitude', 'longitude')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='divesite',
+            index_together=set([('latitude', 'longitude')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='slipway',
+            index_together=set([('latitude', 'longitude')]),
+        ),
+    ]
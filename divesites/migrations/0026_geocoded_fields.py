@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2016-10-18 13:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from divesites.geocoding import parse_geocoding_data
+
+
+def parse_existing_geocoding_data(apps, schema_editor):
+    for model_name in ('Compressor', 'Divesite', 'Slipway'):
+        model = apps.get_model('divesites', model_name)
+        for site in model.objects.exclude(geocoding_data=''):
+            fields = parse_geocoding_data(site.geocoding_data)
+            model.objects.filter(pk=site.pk).update(**fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('divesites', '0025_geocodingresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compressor',
+            name='admin_area_1',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='compressor',
+            name='country',
+            field=models.CharField(blank=True, db_index=True, max_length=2),
+        ),
+        migrations.AddField(
+            model_name='compressor',
+            name='formatted_address',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='compressor',
+            name='locality',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='divesite',
+            name='admin_area_1',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='divesite',
+            name='country',
+            field=models.CharField(blank=True, db_index=True, max_length=2),
+        ),
+        migrations.AddField(
+            model_name='divesite',
+            name='formatted_address',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='divesite',
+            name='locality',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='slipway',
+            name='admin_area_1',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='slipway',
+            name='country',
+            field=models.CharField(blank=True, db_index=True, max_length=2),
+        ),
+        migrations.AddField(
+            model_name='slipway',
+            name='formatted_address',
+            field=models.CharField(blank=True, max_length=500),
+        ),
+        migrations.AddField(
+            model_name='slipway',
+            name='locality',
+            field=models.CharField(blank=True, db_index=True, max_length=200),
+        ),
+        migrations.RunPython(parse_existing_geocoding_data, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2016-10-18 14:00
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+def count_existing_dives(apps, schema_editor):
+    Divesite = apps.get_model('divesites', 'Divesite')
+    divesites = Divesite.objects.annotate(
+            count=models.Count('dives'),
+            depth=models.Sum('dives__depth'),
+            duration=models.Sum('dives__duration'),
+            ).filter(count__gt=0)
+    for divesite in divesites:
+        Divesite.objects.filter(pk=divesite.pk).update(
+                dive_count=divesite.count,
+                dive_depth_sum=divesite.depth,
+                dive_duration_sum=divesite.duration,
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('divesites', '0026_geocoded_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='divesite',
+            name='dive_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='divesite',
+            name='dive_depth_sum',
+            field=models.DecimalField(decimal_places=1, default=0, max_digits=12),
+        ),
+        migrations.AddField(
+            model_name='divesite',
+            name='dive_duration_sum',
+            field=models.DurationField(default=datetime.timedelta(0)),
+        ),
+        migrations.RunPython(count_existing_dives, migrations.RunPython.noop),
+    ]
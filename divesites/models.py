@@ -1,6 +1,4 @@
 import uuid
-import urllib.request
-import urllib.error
 from actstream import action
 from caching.base import CachingManager, CachingMixin
 from django.contrib.auth.models import User
@@ -9,28 +7,30 @@ from django.contrib.contenttypes.fields import GenericRelation
 from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
-from dsapi.settings import GOOGLE_REVERSE_GEOCODING_URL_STRING_TEMPLATE
 from .validators import validate_duration, validate_latitude, validate_longitude
+from . import spatial, tiles
+from .geocoding import geocoding_queue, same_position
+from dsapi import conditional
 
-def retrieve_geocoding_data(lat, lng):
+
+def position_has_changed(site):
     """
-    Contact the Google reverse-geocoding API to retrieve geocoding
-    data for this lat/lng pair.
+    Return True if site is new, or has moved since it was loaded from (or
+    last saved to) the DB.
     """
-    try:
-        url = GOOGLE_REVERSE_GEOCODING_URL_STRING_TEMPLATE % (lat, lng)
-        reverse_geocoding_json = urllib.request.urlopen(url).read()
-        return reverse_geocoding_json
-    except:
-        # We might get a URLError or HTTPError, but there's really
-        # nothing we can do about it except log it
-        return None
+    if site._state.adding or None in site._original_position:
+        return True
+    return not same_position(site._original_position, (site.latitude, site.longitude))
 
 
 class Divesite(CachingMixin, models.Model):
+    class Meta:
+        # Bounding-box queries filter on both coordinates
+        index_together = [('latitude', 'longitude')]
 
     BOULDERS = 'Blds'
     CLAY = 'Cl'
@@ -75,26 +75,50 @@ class Divesite(CachingMixin, models.Model):
     # Country and administrative-area data; we'll use the Google reverse-geocoding API to retrieve
     # these (and store the JSON in a string in the db)
     geocoding_data = models.TextField(blank=True)
+    # Country, region and locality, parsed out of geocoding_data when it's
+    # retrieved so that we can filter on them
+    country = models.CharField(max_length=2, blank=True, db_index=True)
+    admin_area_1 = models.CharField(max_length=200, blank=True, db_index=True)
+    locality = models.CharField(max_length=200, blank=True, db_index=True)
+    formatted_address = models.CharField(max_length=500, blank=True)
     # Creation metadata
     owner = models.ForeignKey(User, related_name="divesites")
     creation_date = models.DateTimeField(auto_now_add=True)
     # images, through a generic relation
     images = GenericRelation('images.Image')
 
+    # Running totals of the dives logged here, kept up to date by the Dive
+    # signal handlers below, so that averages don't need a dive query. Only
+    # those handlers and update_dive_totals write them (see save)
+    DIVE_TOTAL_FIELDS = ('dive_count', 'dive_depth_sum', 'dive_duration_sum',)
+    dive_count = models.IntegerField(default=0)
+    dive_depth_sum = models.DecimalField(max_digits=12, decimal_places=1, default=0)
+    dive_duration_sum = models.DurationField(default=timedelta(0))
+
     # For site depth, use the mean of the dives logged at this site, or
     # return 0 as a default if nobody's logged a dive here.
     def get_average_maximum_depth(self):
-        if self.dives.all():
-            dives = self.dives.all()
-            return sum([_.depth for _ in dives]) / len(dives)
+        if self.dive_count:
+            return self.dive_depth_sum / self.dive_count
         return 0
     def get_average_duration(self):
         """Return average duration, in minutes"""
-        if self.dives.all():
-            dives = self.dives.all()
-            return  sum([_.duration.total_seconds() for _ in dives]) // (60 * len(dives))
+        if self.dive_count:
+            return self.dive_duration_sum.total_seconds() // (60 * self.dive_count)
         return 0
 
+    def update_dive_totals(self):
+        """Recompute the running dive totals from scratch."""
+        totals = self.dives.no_cache().aggregate(
+                count=models.Count('id'),
+                depth=models.Sum('depth'),
+                duration=models.Sum('duration'),
+                )
+        self.dive_count = totals['count']
+        self.dive_depth_sum = totals['depth'] or 0
+        self.dive_duration_sum = totals['duration'] or timedelta(0)
+        self.save(update_fields=self.DIVE_TOTAL_FIELDS)
+
     def clean(self):
         validate_latitude(self.latitude)
         validate_longitude(self.longitude)
@@ -102,11 +126,23 @@ class Divesite(CachingMixin, models.Model):
 
     def save(self, *args, **kwargs):
         self.clean()
-        # OK, so now the model is OK; let's retrieve geocoding data from Google
-        geocoding_data = retrieve_geocoding_data(self.latitude, self.longitude)
-        if geocoding_data:
-            self.geocoding_data = geocoding_data
+        moved = position_has_changed(self)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None and not args and not self._state.adding and not kwargs.get('force_insert'):
+            # Our copy of the dive totals may be out of date by now (a dive
+            # might have been logged while an edit was in progress), so
+            # don't write it back over the DB's
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                    field.name for field in self._meta.concrete_fields
+                    if not field.primary_key and field.name not in self.DIVE_TOTAL_FIELDS
+                    and field.attname not in deferred]
         super(Divesite, self).save(*args, **kwargs)
+        self._original_position = (self.latitude, self.longitude)
+        # OK, so now the model is saved; if it's somewhere new, geocoding
+        # data from Google will be filled in in the background
+        if moved:
+            geocoding_queue.schedule(self, update_fields)
 
 
 class Dive(CachingMixin, models.Model):
@@ -181,6 +217,9 @@ class Dive(CachingMixin, models.Model):
 
 
 class Compressor(CachingMixin, models.Model):
+    class Meta:
+        index_together = [('latitude', 'longitude')]
+
     def __str__(self):
         return self.name
 
@@ -198,19 +237,30 @@ class Compressor(CachingMixin, models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     # Geocoding data
     geocoding_data = models.TextField(blank=True)
+    # Country, region and locality, parsed out of geocoding_data when it's
+    # retrieved so that we can filter on them
+    country = models.CharField(max_length=2, blank=True, db_index=True)
+    admin_area_1 = models.CharField(max_length=200, blank=True, db_index=True)
+    locality = models.CharField(max_length=200, blank=True, db_index=True)
+    formatted_address = models.CharField(max_length=500, blank=True)
 
     # images, through a generic relation
     images = GenericRelation('images.Image')
 
     def save(self, *args, **kwargs):
-        # Try to retrieve geocoding data from Google
-        geocoding_data = retrieve_geocoding_data(self.latitude, self.longitude)
-        if geocoding_data:
-            self.geocoding_data = geocoding_data
+        moved = position_has_changed(self)
         super(Compressor, self).save(*args, **kwargs)
+        self._original_position = (self.latitude, self.longitude)
+        # Retrieve geocoding data from Google in the background, but only
+        # if the position has changed
+        if moved:
+            geocoding_queue.schedule(self, kwargs.get('update_fields'))
 
 
 class Slipway(CachingMixin, models.Model):
+    class Meta:
+        index_together = [('latitude', 'longitude')]
+
     def __str__(self):
         return self.name
 
@@ -228,16 +278,65 @@ class Slipway(CachingMixin, models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     # Geocoding data
     geocoding_data = models.TextField(blank=True)
+    # Country, region and locality, parsed out of geocoding_data when it's
+    # retrieved so that we can filter on them
+    country = models.CharField(max_length=2, blank=True, db_index=True)
+    admin_area_1 = models.CharField(max_length=200, blank=True, db_index=True)
+    locality = models.CharField(max_length=200, blank=True, db_index=True)
+    formatted_address = models.CharField(max_length=500, blank=True)
 
     # images, through a generic relation
     images = GenericRelation('images.Image')
 
     def save(self, *args, **kwargs):
-        # Try to retrieve geocoding data from Google
-        geocoding_data = retrieve_geocoding_data(self.latitude, self.longitude)
-        if geocoding_data:
-            self.geocoding_data = geocoding_data
+        moved = position_has_changed(self)
         super(Slipway, self).save(*args, **kwargs)
+        self._original_position = (self.latitude, self.longitude)
+        # Retrieve geocoding data from Google in the background, but only
+        # if the position has changed
+        if moved:
+            geocoding_queue.schedule(self, kwargs.get('update_fields'))
+
+
+class GeocodingResult(models.Model):
+    """
+    A reverse-geocoding response for a position, rounded to
+    GEOCODING_CACHE_PRECISION decimal places (see divesites.geocoding).
+    """
+    class Meta:
+        unique_together = [('latitude', 'longitude')]
+
+    latitude = models.DecimalField(max_digits=9, decimal_places=6)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6)
+    geocoding_data = models.TextField()
+    retrieval_date = models.DateTimeField(default=timezone.now)
+
+
+#
+# Post-init signals
+#
+
+# Remember where a site was when it was loaded, so that when it's saved we
+# can tell where it has moved from. (Read the instance's __dict__ so that
+# deferred coordinates aren't fetched one instance at a time.)
+def remember_site_position(sender, instance, **kwargs):
+    instance._original_position = (
+            instance.__dict__.get('latitude'),
+            instance.__dict__.get('longitude'),
+            )
+post_init.connect(remember_site_position, sender=Compressor)
+post_init.connect(remember_site_position, sender=Divesite)
+post_init.connect(remember_site_position, sender=Slipway)
+
+# Likewise, remember where a dive was logged and what went into the site's
+# totals for it, so that an edit can take the old values back out
+def remember_dive_totals(sender, instance, **kwargs):
+    instance._original_totals = (
+            instance.__dict__.get('divesite_id'),
+            instance.__dict__.get('depth'),
+            instance.__dict__.get('duration'),
+            )
+post_init.connect(remember_dive_totals, sender=Dive)
 
 
 #
@@ -262,3 +361,82 @@ def send_dive_creation_action(sender, instance, created, **kwargs):
         # print('%s %s %s' % (instance.diver, verb, instance.divesite))
         action.send(instance.diver, verb='logged a dive', action_object=instance, target=instance.divesite)
 post_save.connect(send_dive_creation_action, sender=Dive)
+
+# Add to (or with sign=-1, take away from) a divesite's running dive
+# totals. The arithmetic is done by the DB, so concurrent dives can't lose
+# each other's updates; a copy of the site already in memory is kept in step.
+def adjust_dive_totals(dive, divesite_id, count, depth, duration):
+    Divesite.objects.filter(pk=divesite_id).update(
+            dive_count=models.F('dive_count') + count,
+            dive_depth_sum=models.F('dive_depth_sum') + depth,
+            dive_duration_sum=models.F('dive_duration_sum') + duration,
+            )
+    # Cache Machine doesn't notice update() calls
+    Divesite.objects.invalidate(Divesite(pk=divesite_id))
+    divesite = getattr(dive, Dive.divesite.cache_name, None)
+    if divesite is not None and divesite.pk == divesite_id:
+        divesite.dive_count += count
+        divesite.dive_depth_sum += depth
+        divesite.dive_duration_sum += duration
+
+def update_dive_totals_on_save(sender, instance, created, **kwargs):
+    old_divesite_id, old_depth, old_duration = instance._original_totals
+    new_totals = (instance.divesite_id, instance.depth, instance.duration)
+    if created:
+        adjust_dive_totals(instance, instance.divesite_id, 1, instance.depth, instance.duration)
+    elif None in instance._original_totals:
+        # The dive was loaded without these fields, so we don't know what
+        # it used to contribute; count the sites' dives again
+        for divesite in Divesite.objects.no_cache().filter(pk__in=[old_divesite_id, instance.divesite_id]):
+            divesite.update_dive_totals()
+    elif old_divesite_id != instance.divesite_id:
+        adjust_dive_totals(instance, old_divesite_id, -1, -old_depth, -old_duration)
+        adjust_dive_totals(instance, instance.divesite_id, 1, instance.depth, instance.duration)
+    elif new_totals != instance._original_totals:
+        adjust_dive_totals(instance, instance.divesite_id, 0,
+                instance.depth - old_depth, instance.duration - old_duration)
+    instance._original_totals = new_totals
+post_save.connect(update_dive_totals_on_save, sender=Dive)
+
+def update_dive_totals_on_delete(sender, instance, **kwargs):
+    if None in instance._original_totals:
+        for divesite in Divesite.objects.no_cache().filter(pk=instance.divesite_id):
+            divesite.update_dive_totals()
+    else:
+        divesite_id, depth, duration = instance._original_totals
+        adjust_dive_totals(instance, divesite_id, -1, -depth, -duration)
+post_delete.connect(update_dive_totals_on_delete, sender=Dive)
+
+# When a site is saved or deleted, drop the cached map tiles for where it
+# is and where it was. We do that straight away, for the benefit of this
+# transaction, and again after commit, in case another request has cached
+# the old version of a tile in the meantime.
+def invalidate_site_tiles(sender, instance, **kwargs):
+    positions = set([
+        (instance.latitude, instance.longitude),
+        instance._original_position,
+        ])
+    positions.discard((None, None))
+    tiles.invalidate_tiles(positions)
+    transaction.on_commit(lambda: tiles.invalidate_tiles(positions))
+post_save.connect(invalidate_site_tiles, sender=Compressor)
+post_save.connect(invalidate_site_tiles, sender=Divesite)
+post_save.connect(invalidate_site_tiles, sender=Slipway)
+post_delete.connect(invalidate_site_tiles, sender=Compressor)
+post_delete.connect(invalidate_site_tiles, sender=Divesite)
+post_delete.connect(invalidate_site_tiles, sender=Slipway)
+
+
+# Keep an in-process spatial index of each kind of site, so that we can
+# answer 'what's near here?' without scanning whole tables.
+spatial.register(Compressor)
+spatial.register(Divesite)
+spatial.register(Slipway)
+# ...and map clusters of divesites for every zoom level
+spatial.register_clusters(Divesite)
+
+# Keep version stamps for conditional GETs (see dsapi.conditional)
+conditional.track(Compressor, 'owner')
+conditional.track(Dive, 'divesite', 'diver')
+conditional.track(Divesite, 'owner')
+conditional.track(Slipway, 'owner')
@@ -1,17 +1,29 @@
 from datetime import datetime, timedelta
-import haversine
+from django.conf import settings
 from django.utils import timezone
 from rest_framework import serializers
+from dsapi.serializers import SparseFieldsetMixin
 from profiles.serializers import MinimalProfileSerializer, ProfileSerializer
 from profiles.models import Profile
-from divesites.models import Dive, Divesite
+from divesites.models import Compressor, Dive, Divesite, Slipway
 from . import models
+from . import spatial
 from . import validators
+# Site fields filled in from geocoding data; clients can't set these
+from .geocoding import GEOCODED_FIELDS
 
-class DivesiteDistanceValidator(object):
 
-    def __init__(self, queryset):
+class SiteDistanceValidator(object):
+    """
+    Reject a site that would be within `radius` metres (by default
+    settings.MINIMUM_SITE_SEPARATION) of an existing site in queryset.
+    Candidates come from the model's spatial index, so this doesn't scan
+    the table.
+    """
+
+    def __init__(self, queryset, radius=None):
         self.queryset = queryset
+        self.radius = radius
 
     def set_context(self, serializer):
         self.instance = getattr(serializer, 'instance', None)
@@ -26,9 +38,6 @@ class DivesiteDistanceValidator(object):
         return queryset
 
     def __call__(self, attrs):
-        from decimal import Decimal
-        # XXX: very shaky
-        JUST_OVER_100_M_IN_DEGREES = Decimal(0.001)
         self.enforce_required_fields(attrs)
         if 'latitude' in attrs.keys():
             latitude = attrs['latitude']
@@ -38,19 +47,20 @@ class DivesiteDistanceValidator(object):
             longitude = attrs['longitude']
         else:
             longitude = self.instance.longitude
-        queryset = self.queryset
-        queryset = self.exclude_current_instance(attrs, queryset)
-        # Filter on latitude value
-        queryset = queryset.filter(latitude__gte=latitude-JUST_OVER_100_M_IN_DEGREES)
-        queryset = queryset.filter(latitude__lte=latitude+JUST_OVER_100_M_IN_DEGREES)
-        # Filter on longitude value
-        queryset = queryset.filter(longitude__gte=longitude-JUST_OVER_100_M_IN_DEGREES)
-        queryset = queryset.filter(longitude__lte=longitude+JUST_OVER_100_M_IN_DEGREES)
-        if queryset.exists():
-            raise serializers.ValidationError('Too close to an existing divesite')
-
-
-class DiveSerializer(serializers.ModelSerializer):
+        radius = self.radius
+        if radius is None:
+            radius = settings.MINIMUM_SITE_SEPARATION
+        model = self.queryset.model
+        hits = spatial.get_index(model).within(latitude, longitude, radius / 1000)
+        if not hits:
+            return
+        # The index only suggests candidates; check them against the DB
+        queryset = self.exclude_current_instance(attrs, self.queryset)
+        if queryset.filter(pk__in=[pk for _, pk in hits]).exists():
+            raise serializers.ValidationError('Too close to an existing %s' % model._meta.verbose_name)
+
+
+class DiveSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Dive
         fields = ('comment', 'diver', 'id', 'depth', 'duration', 'divesite',
@@ -75,13 +85,13 @@ class DiveSerializer(serializers.ModelSerializer):
         return duration
 
 
-class MinimalDivesiteSerializer(serializers.ModelSerializer):
+class MinimalDivesiteSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Divesite
         fields = ('id', 'name')
 
 
-class DiveListSerializer(serializers.ModelSerializer):
+class DiveListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Dive
         fields = ('id', 'comment', 'depth', 'duration', 'date', 'time', 'divesite', 'diver',
@@ -92,7 +102,7 @@ class DiveListSerializer(serializers.ModelSerializer):
     divesite = MinimalDivesiteSerializer(read_only=True)
 
 
-class DivesiteSerializer(serializers.ModelSerializer):
+class DivesiteSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     """Serialize everything we know about a Divesite."""
     class Meta:
         model = models.Divesite
@@ -102,9 +112,11 @@ class DivesiteSerializer(serializers.ModelSerializer):
                 'description',
                 'owner',
                 'geocoding_data',
+                'country', 'admin_area_1', 'locality', 'formatted_address',
                 )
+        read_only_fields = GEOCODED_FIELDS
         validators = [
-                DivesiteDistanceValidator(queryset=Divesite.objects.all())
+                SiteDistanceValidator(queryset=Divesite.objects.all())
                 ]
 
     dives = DiveListSerializer(many=True, read_only=True)
@@ -129,25 +141,49 @@ class DivesiteSerializer(serializers.ModelSerializer):
         return attrs
 
 
-class DivesiteListSerializer(serializers.ModelSerializer):
+class DivesiteListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    # Send the fields parsed out of the geocoding data rather than the
+    # (much bigger) raw response
     class Meta:
         model = models.Divesite
-        fields = ('id', 'depth', 'duration', 'geocoding_data', 'level',
+        fields = ('id', 'depth', 'duration', 'level',
                 'boat_entry', 'shore_entry', 'boat_entry',
-                'latitude', 'longitude', 'name', 'owner',)
+                'latitude', 'longitude', 'name', 'owner',) + GEOCODED_FIELDS
     depth = serializers.ReadOnlyField(source='get_average_maximum_depth')
     duration = serializers.ReadOnlyField(source='get_average_duration')
     # Give a small amount of information about the owner
     owner = MinimalProfileSerializer(source='owner.profile', read_only=True)
 
 
-class CompressorSerializer(serializers.ModelSerializer):
+class CompressorSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    class Meta:
+        model = models.Compressor
+        read_only_fields = GEOCODED_FIELDS
+        validators = [
+                SiteDistanceValidator(queryset=Compressor.objects.all())
+                ]
+    owner = MinimalProfileSerializer(source='owner.profile', read_only=True)
+
+
+class CompressorListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Compressor
+        exclude = ('geocoding_data',)
+    owner = MinimalProfileSerializer(source='owner.profile', read_only=True)
+
+
+class SlipwaySerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    class Meta:
+        model = models.Slipway
+        read_only_fields = GEOCODED_FIELDS
+        validators = [
+                SiteDistanceValidator(queryset=Slipway.objects.all())
+                ]
     owner = MinimalProfileSerializer(source='owner.profile', read_only=True)
 
 
-class SlipwaySerializer(serializers.ModelSerializer):
+class SlipwayListSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = models.Slipway
+        exclude = ('geocoding_data',)
     owner = MinimalProfileSerializer(source='owner.profile', read_only=True)
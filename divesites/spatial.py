@@ -0,0 +1,407 @@
+"""
+In-process spatial indexes for site models.
+
+SpatialIndex buckets sites into a fixed grid of latitude/longitude cells,
+so a radius query only has to look at the handful of cells around the
+query point rather than at every row in the table. ClusterIndex keeps
+grid clusters of sites for each map zoom level. Each process keeps its own
+copy of the index; a version token in the shared cache tells a process
+that another one has changed the underlying table, and that it should
+reload.
+
+The indexes are only ever used to generate candidates: callers should resolve
+the returned primary keys against the database (see `SpatialIndex.resolve`)
+so that rows deleted elsewhere never make it into a response.
+"""
+import math
+import threading
+import uuid
+from collections import defaultdict
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from haversine import haversine
+
+# Size of a grid cell, in degrees; 0.1 degrees of latitude is about 11 km
+CELL_SIZE_DEGREES = 0.1
+# haversine uses a mean Earth radius of 6371 km
+KM_PER_DEGREE = math.pi * 6371 / 180
+# Nothing on the surface is further away than this
+HALF_EARTH_CIRCUMFERENCE_KM = 180 * KM_PER_DEGREE
+# Where a k-nearest search starts looking before it widens the radius
+INITIAL_SEARCH_RADIUS_KM = 10
+# Web-mercator maps stop short of the poles
+MAX_MERCATOR_LATITUDE = 85.0511287798
+# Clusters are kept for zoom levels 0 to MAX_CLUSTER_ZOOM. At zoom z the
+# world is 2 ** z tiles of 256 pixels across, and each tile is split into
+# 2 ** CLUSTER_CELL_BITS clusters on a side (i.e., 64 pixels each)
+MAX_CLUSTER_ZOOM = 16
+CLUSTER_CELL_BITS = 2
+
+
+def mercator(latitude, longitude):
+    """
+    Project a position into web-mercator world coordinates: x and y both
+    run from 0 to 1, starting from the top left (180W, 85.05N).
+    """
+    latitude = max(min(latitude, MAX_MERCATOR_LATITUDE), -MAX_MERCATOR_LATITUDE)
+    sin_latitude = math.sin(math.radians(latitude))
+    x = (longitude + 180) / 360
+    y = 0.5 - math.log((1 + sin_latitude) / (1 - sin_latitude)) / (4 * math.pi)
+    return min(x, 1.0), min(max(y, 0.0), 1.0)
+
+
+class PointIndex(object):
+    """
+    Base class for in-process indexes of site positions. Subclasses
+    arrange the points however suits their queries by implementing
+    _place, _unplace and _clear.
+    """
+    kind = 'point-index'
+
+    def __init__(self, model):
+        self.model = model
+        self.version_key = '%s:%s' % (self.kind, model._meta.label_lower)
+        self._lock = threading.RLock()
+        self._points = {}
+        self._loaded = False
+        self._version = None
+
+    def _place(self, pk, latitude, longitude):
+        raise NotImplementedError
+
+    def _unplace(self, pk, latitude, longitude):
+        raise NotImplementedError
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _insert(self, pk, latitude, longitude):
+        self._points[pk] = (latitude, longitude)
+        self._place(pk, latitude, longitude)
+
+    def _remove(self, pk):
+        position = self._points.pop(pk, None)
+        if position is not None:
+            self._unplace(pk, *position)
+
+    def _ensure_loaded(self):
+        version = cache.get(self.version_key)
+        with self._lock:
+            if self._loaded and version == self._version:
+                return
+            self._clear()
+            self._points.clear()
+            # Cache Machine doesn't play well with values_list, so bypass it
+            rows = self.model.objects.no_cache().values_list('pk', 'latitude', 'longitude')
+            for pk, latitude, longitude in rows:
+                self._insert(pk, float(latitude), float(longitude))
+            self._loaded = True
+            self._version = version
+
+    def add(self, pk, latitude, longitude):
+        with self._lock:
+            self._remove(pk)
+            self._insert(pk, float(latitude), float(longitude))
+
+    def discard(self, pk):
+        with self._lock:
+            self._remove(pk)
+
+    def invalidate(self):
+        """Throw away this process's copy; it's reloaded on next use."""
+        with self._lock:
+            self._loaded = False
+
+    def publish(self):
+        """Tell other processes that the table has changed."""
+        version = uuid.uuid4().hex
+        cache.set(self.version_key, version, None)
+        with self._lock:
+            self._version = version
+
+
+class SpatialIndex(PointIndex):
+    kind = 'spatial-index'
+
+    def __init__(self, model, cell_size=CELL_SIZE_DEGREES):
+        super(SpatialIndex, self).__init__(model)
+        self.cell_size = cell_size
+        self.rows = int(round(180 / cell_size))
+        self.columns = int(round(360 / cell_size))
+        self._cells = defaultdict(set)
+
+    def _cell(self, latitude, longitude):
+        row = int(math.floor((latitude + 90) / self.cell_size))
+        column = int(math.floor((longitude + 180) / self.cell_size))
+        # Latitude 90 would otherwise fall off the top of the grid, and
+        # longitude 180 is the same meridian as longitude -180
+        return min(row, self.rows - 1), column % self.columns
+
+    def _place(self, pk, latitude, longitude):
+        self._cells[self._cell(latitude, longitude)].add(pk)
+
+    def _unplace(self, pk, latitude, longitude):
+        cell = self._cell(latitude, longitude)
+        self._cells[cell].discard(pk)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def _clear(self):
+        self._cells.clear()
+
+    def _candidate_cells(self, latitude, longitude, radius_km):
+        """
+        Return the rows and the columns of the grid cells that could hold
+        points within radius_km of the given position.
+        """
+        delta_latitude = radius_km / KM_PER_DEGREE
+        south = max(latitude - delta_latitude, -90)
+        north = min(latitude + delta_latitude, 90)
+        first_row, _ = self._cell(south, 0)
+        last_row, _ = self._cell(north, 0)
+        rows = range(first_row, last_row + 1)
+        # A degree of longitude is shortest at the edge of the band nearest
+        # the pole, so that's the latitude that sets how wide we look
+        widest = max(abs(south), abs(north))
+        if widest >= 90:
+            return rows, range(self.columns)
+        delta_longitude = delta_latitude / math.cos(math.radians(widest))
+        if delta_longitude >= 180:
+            return rows, range(self.columns)
+        first = int(math.floor((longitude - delta_longitude + 180) / self.cell_size))
+        last = int(math.floor((longitude + delta_longitude + 180) / self.cell_size))
+        return rows, set(column % self.columns for column in range(first, last + 1))
+
+    def within(self, latitude, longitude, radius_km):
+        """
+        Return a list of (distance, pk) pairs for every indexed point within
+        radius_km of the given position, nearest first.
+        """
+        self._ensure_loaded()
+        origin = (float(latitude), float(longitude))
+        hits = []
+        with self._lock:
+            rows, columns = self._candidate_cells(origin[0], origin[1], radius_km)
+            if len(rows) * len(columns) < len(self._cells):
+                cells = [(row, column) for row in rows for column in columns]
+            else:
+                # A wide search of a sparse grid (up to every one of its
+                # millions of cells) is cheaper the other way round
+                cells = [cell for cell in self._cells if cell[0] in rows and cell[1] in columns]
+            for cell in cells:
+                for pk in self._cells.get(cell, ()):
+                    distance = haversine(origin, self._points[pk])
+                    if distance <= radius_km:
+                        hits.append((distance, pk))
+        hits.sort(key=lambda hit: hit[0])
+        return hits
+
+    def nearest(self, latitude, longitude, k, radius_km=None):
+        """
+        Return (distance, pk) pairs for the k indexed points nearest to the
+        given position, optionally no further away than radius_km. The
+        search radius is widened until it holds at least k points, so
+        only the cells that could contain an answer are examined.
+        """
+        limit = HALF_EARTH_CIRCUMFERENCE_KM if radius_km is None else radius_km
+        radius = min(INITIAL_SEARCH_RADIUS_KM, limit)
+        while True:
+            hits = self.within(latitude, longitude, radius)
+            if len(hits) >= k or radius >= limit:
+                return hits[:k]
+            radius = min(radius * 4, limit)
+
+    def find(self, queryset, latitude, longitude, k, radius_km=None):
+        """
+        Return up to k objects from queryset nearest to the given position
+        (see `nearest`), each with a `distance` attribute. If some of the
+        candidates turn out to have been deleted, search again without them.
+        """
+        while True:
+            hits = self.nearest(latitude, longitude, k, radius_km)
+            size = len(self._points)
+            results = self.resolve(queryset, hits)
+            if len(results) == len(hits) or len(self._points) == size:
+                return results
+
+    def resolve(self, queryset, hits):
+        """
+        Fetch the objects for a list of (distance, pk) pairs from queryset,
+        in the same order, setting a `distance` attribute (in km) on each.
+        Anything that has disappeared from the table is dropped from the
+        index as well as from the result.
+        """
+        objects = queryset.in_bulk([pk for _, pk in hits])
+        results = []
+        for distance, pk in hits:
+            obj = objects.get(pk)
+            if obj is None:
+                # Only forget about points that are really gone, not ones
+                # that the caller's queryset happened to filter out
+                if not self.model.objects.no_cache().filter(pk=pk).exists():
+                    self.discard(pk)
+                continue
+            obj.distance = distance
+            results.append(obj)
+        return results
+
+
+class ClusterIndex(PointIndex):
+    """
+    Grid clusters of sites at every map zoom level, kept up to date one
+    point at a time as sites are added, moved and removed.
+    """
+    kind = 'cluster-index'
+
+    def __init__(self, model):
+        super(ClusterIndex, self).__init__(model)
+        # One dict per zoom level, mapping a grid cell to a list of
+        # [sum of latitudes, sum of longitudes, set of primary keys,
+        # [min latitude, min longitude, max latitude, max longitude]]
+        self._levels = [{} for _ in range(MAX_CLUSTER_ZOOM + 1)]
+
+    def _cells(self, latitude, longitude):
+        x, y = mercator(latitude, longitude)
+        for zoom in range(MAX_CLUSTER_ZOOM + 1):
+            size = 2 ** (zoom + CLUSTER_CELL_BITS)
+            yield zoom, (min(int(x * size), size - 1), min(int(y * size), size - 1))
+
+    def _place(self, pk, latitude, longitude):
+        for zoom, cell in self._cells(latitude, longitude):
+            cluster = self._levels[zoom].get(cell)
+            if cluster is None:
+                cluster = self._levels[zoom][cell] = [0.0, 0.0, set(), [latitude, longitude, latitude, longitude]]
+            cluster[0] += latitude
+            cluster[1] += longitude
+            cluster[2].add(pk)
+            bounds = cluster[3]
+            bounds[:] = [
+                    min(bounds[0], latitude), min(bounds[1], longitude),
+                    max(bounds[2], latitude), max(bounds[3], longitude),
+                    ]
+
+    def _unplace(self, pk, latitude, longitude):
+        for zoom, cell in self._cells(latitude, longitude):
+            cluster = self._levels[zoom][cell]
+            cluster[2].discard(pk)
+            if cluster[2]:
+                cluster[0] -= latitude
+                cluster[1] -= longitude
+                # Only a point on the edge of the cluster can shrink it
+                if latitude in cluster[3][::2] or longitude in cluster[3][1::2]:
+                    cluster[3][:] = self._bounds(cluster[2])
+            else:
+                del self._levels[zoom][cell]
+
+    def _bounds(self, pks):
+        latitudes, longitudes = zip(*(self._points[pk] for pk in pks))
+        return [min(latitudes), min(longitudes), max(latitudes), max(longitudes)]
+
+    def _clear(self):
+        for level in self._levels:
+            level.clear()
+
+    def clusters(self, zoom, bbox=None):
+        """
+        Return the clusters at a zoom level whose cells overlap bbox, a
+        (min_lng, min_lat, max_lng, max_lat) tuple, as dicts holding the
+        centroid, size and bounds (in the same order as bbox) of each
+        cluster. A cluster of one site also carries the site's primary key.
+        """
+        self._ensure_loaded()
+        zoom = max(0, min(zoom, MAX_CLUSTER_ZOOM))
+        size = 2 ** (zoom + CLUSTER_CELL_BITS)
+        with self._lock:
+            level = self._levels[zoom]
+            if bbox is None:
+                cells = list(level.keys())
+            else:
+                min_lng, min_lat, max_lng, max_lat = bbox
+                left, bottom = mercator(min_lat, min_lng)
+                right, top = mercator(max_lat, max_lng)
+                rows = range(int(top * size), min(int(bottom * size), size - 1) + 1)
+                if min_lng <= max_lng:
+                    columns = list(range(int(left * size), min(int(right * size), size - 1) + 1))
+                else:
+                    # The box crosses the antimeridian
+                    columns = list(range(int(left * size), size)) + list(range(0, int(right * size) + 1))
+                if len(rows) * len(columns) < len(level):
+                    cells = [(x, y) for y in rows for x in columns if (x, y) in level]
+                else:
+                    columns, rows = set(columns), set(rows)
+                    cells = [(x, y) for x, y in level.keys() if x in columns and y in rows]
+            results = []
+            for cell in cells:
+                sum_latitude, sum_longitude, pks, bounds = level[cell]
+                count = len(pks)
+                cluster = {
+                        'latitude': sum_latitude / count,
+                        'longitude': sum_longitude / count,
+                        'count': count,
+                        'bounds': [bounds[1], bounds[0], bounds[3], bounds[2]],
+                        }
+                if count == 1:
+                    cluster['id'] = next(iter(pks))
+                results.append(cluster)
+        return results
+
+
+_indexes = {}
+_cluster_indexes = {}
+
+
+def get_index(model):
+    return _indexes[model]
+
+
+def get_cluster_index(model):
+    return _cluster_indexes[model]
+
+
+def _has_moved(instance, update_fields=None):
+    """
+    Return True if a save of instance could have changed its position:
+    sites remember where they were loaded from (see divesites.models), so
+    anything saved in the same place, or saved without its position, is
+    left alone.
+    """
+    if update_fields is not None and not set(['latitude', 'longitude']) & set(update_fields):
+        return False
+    original = getattr(instance, '_original_position', (None, None))
+    if None in original:
+        return True
+    return tuple(float(_) for _ in original) != (float(instance.latitude), float(instance.longitude))
+
+
+def _keep_up_to_date(index):
+    """Keep index in step with saves and deletes of its model."""
+
+    def update_index(sender, instance, created, update_fields=None, **kwargs):
+        # Saves that don't move a site (of geocoding data, dive totals,
+        # descriptions, ...) would otherwise make every process reload
+        if not created and not _has_moved(instance, update_fields):
+            return
+        index.add(instance.pk, instance.latitude, instance.longitude)
+        transaction.on_commit(index.publish)
+
+    def remove_from_index(sender, instance, **kwargs):
+        index.discard(instance.pk)
+        transaction.on_commit(index.publish)
+
+    uid = index.version_key
+    post_save.connect(update_index, sender=index.model, weak=False, dispatch_uid=uid)
+    post_delete.connect(remove_from_index, sender=index.model, weak=False, dispatch_uid=uid)
+    return index
+
+
+def register(model):
+    """Create a spatial index for model."""
+    _indexes[model] = _keep_up_to_date(SpatialIndex(model))
+    return _indexes[model]
+
+
+def register_clusters(model):
+    """Create a cluster index for model."""
+    _cluster_indexes[model] = _keep_up_to_date(ClusterIndex(model))
+    return _cluster_indexes[model]
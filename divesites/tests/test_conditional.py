@@ -0,0 +1,171 @@
+import json
+import time
+from unittest.mock import Mock, patch
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from divesites import factories
+
+
+def clock(now):
+    return patch('dsapi.conditional.time', Mock(time=Mock(return_value=now)))
+
+
+def a_second_later():
+    # Last-Modified is only sent once the second of the last change is
+    # over (tags are stamped the first time they're asked for, too)
+    return clock(time.time() + 1)
+
+
+class ConditionalGetTestCase(APITestCase):
+
+    def setUp(self):
+        self.divesite = factories.DivesiteFactory()
+        self.url = reverse('divesite-list')
+
+    def test_responses_carry_validators(self):
+        self.client.get(self.url)
+        with a_second_later():
+            response = self.client.get(self.url)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+
+    def test_last_modified_waits_for_the_end_of_the_second(self):
+        with clock(1000.5):
+            factories.DivesiteFactory()
+            response = self.client.get(self.url)
+            self.assertIn('ETag', response)
+            self.assertNotIn('Last-Modified', response)
+            # ...so a change later in the second can't be missed
+            response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE='Thu, 01 Jan 1970 00:16:40 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_unchanged_resources_return_304(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b'')
+
+    def test_changes_invalidate_etags(self):
+        etag = self.client.get(self.url)['ETag']
+        factories.DiveFactory(divesite=self.divesite)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etags_depend_on_the_query(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, {'fields': 'id'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_if_modified_since(self):
+        self.client.get(self.url)
+        with a_second_later():
+            last_modified = self.client.get(self.url)['Last-Modified']
+            response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_logging_in_isnt_a_change(self):
+        etag = self.client.get(self.url)['ETag']
+        self.client.force_login(self.divesite.owner)
+        self.client.logout()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_function_views_are_conditional(self):
+        url = reverse('tile', args=[0, 0, 0])
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_permissions_are_checked_first(self):
+        response = self.client.get(reverse('profile-me'), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ResponseCacheTestCase(APITestCase):
+
+    def setUp(self):
+        self.divesite = factories.DivesiteFactory()
+        self.url = reverse('divesite-detail', args=[self.divesite.id])
+
+    def test_anonymous_responses_are_cached(self):
+        content = self.client.get(self.url).content
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, content)
+
+    def test_changes_invalidate_cached_responses(self):
+        self.client.get(self.url)
+        factories.DiveFactory(divesite=self.divesite)
+        response = self.client.get(self.url)
+        self.assertEqual(len(json.loads(response.content.decode('utf-8'))['dives']), 1)
+
+    def test_authenticated_responses_arent_cached(self):
+        self.client.force_authenticate(self.divesite.owner)
+        self.client.get(self.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url)
+        self.assertTrue(queries.captured_queries)
+
+
+class ScopedVersionTestCase(APITestCase):
+
+    def setUp(self):
+        self.divesite = factories.DivesiteFactory()
+
+    def get_etag(self, url):
+        return self.client.get(url)['ETag']
+
+    def assertStatus(self, url, etag, status_code):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status_code)
+        return response
+
+    def test_other_sites_dont_invalidate_a_site(self):
+        url = reverse('divesite-detail', args=[self.divesite.id])
+        etag = self.get_etag(url)
+        owner = self.divesite.owner
+        factories.DiveFactory(divesite=factories.DivesiteFactory(owner=owner), diver=owner)
+        self.assertStatus(url, etag, status.HTTP_304_NOT_MODIFIED)
+
+    def test_moving_a_dive_invalidates_both_sites(self):
+        dive = factories.DiveFactory(divesite=self.divesite)
+        url = reverse('divesite-dives', args=[self.divesite.id])
+        etag = self.get_etag(url)
+        dive.divesite = factories.DivesiteFactory(owner=self.divesite.owner)
+        dive.save()
+        response = self.assertStatus(url, etag, status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+
+    def test_moving_a_site_invalidates_its_nearby_slipways(self):
+        factories.SlipwayFactory(latitude=self.divesite.latitude, longitude=self.divesite.longitude)
+        url = reverse('divesite-nearby-slipways', args=[self.divesite.id])
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), 1)
+        # Move the site to the other side of the world
+        self.divesite.latitude = -self.divesite.latitude
+        self.divesite.longitude += -180 if self.divesite.longitude > 0 else 180
+        self.divesite.save()
+        response = self.assertStatus(url, response['ETag'], status.HTTP_200_OK)
+        self.assertEqual(response.data, [])
+        # ...and not from the response cache either
+        self.assertEqual(len(json.loads(self.client.get(url).content.decode('utf-8'))), 0)
+
+    def test_deleted_sites_arent_served_from_the_cache(self):
+        url = reverse('divesite-nearby-slipways', args=[self.divesite.id])
+        self.client.get(url)
+        self.divesite.delete()
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_other_users_dives_dont_invalidate_a_profile(self):
+        url = reverse('profile-detail', args=[self.divesite.owner.profile.id])
+        etag = self.get_etag(url)
+        factories.DiveFactory(divesite=self.divesite)
+        self.assertStatus(url, etag, status.HTTP_304_NOT_MODIFIED)
+        factories.DiveFactory(divesite=self.divesite, diver=self.divesite.owner)
+        self.assertStatus(url, etag, status.HTTP_200_OK)
@@ -0,0 +1,269 @@
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+
+from rest_framework.test import APITestCase
+
+from divesites import factories
+from divesites.geocoding import geocoding_cache, geocoding_queue, parse_geocoding_data
+from divesites.models import Compressor, Divesite, GeocodingResult, Slipway
+
+GEOCODING_DATA = '{"results": [], "status": "OK"}'
+
+DUBLIN_GEOCODING_DATA = json.dumps({
+    'status': 'OK',
+    'results': [
+        {
+            'formatted_address': '1 Harbour Road, Howth, Co. Dublin, Ireland',
+            'address_components': [
+                {'long_name': 'Howth', 'short_name': 'Howth', 'types': ['locality', 'political']},
+                {'long_name': 'Ireland', 'short_name': 'IE', 'types': ['country', 'political']},
+                ],
+            },
+        {
+            'formatted_address': 'County Dublin, Ireland',
+            'address_components': [
+                {'long_name': 'County Dublin', 'short_name': 'D',
+                    'types': ['administrative_area_level_1', 'political']},
+                ],
+            },
+        ],
+    })
+
+
+# Stand in for the Google geocoder, and run jobs inside save() rather than
+# after commit (which never happens inside a test case)
+@patch('divesites.geocoding.fetch_geocoding_data', return_value=GEOCODING_DATA)
+class GeocodingQueueTestCase(APITestCase):
+
+    def setUp(self):
+        geocoding_cache.clear()
+
+    def test_sites_are_geocoded_after_saving(self, mock):
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            sites = [
+                    factories.CompressorFactory(),
+                    factories.DivesiteFactory(),
+                    factories.SlipwayFactory(),
+                    ]
+        for site in sites:
+            site = type(site).objects.get(pk=site.pk)
+            self.assertEqual(site.geocoding_data, GEOCODING_DATA)
+
+    def test_geocoding_waits_for_commit(self, mock):
+        ds = factories.DivesiteFactory()
+        self.assertFalse(mock.called)
+        self.assertEqual(Divesite.objects.get(pk=ds.pk).geocoding_data, '')
+
+    def test_saving_geocoding_data_doesnt_geocode_again(self, mock):
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            factories.DivesiteFactory()
+        self.assertEqual(mock.call_count, 1)
+
+    def test_geocoder_failure_leaves_site_alone(self, mock):
+        mock.side_effect = OSError('geocoder is down')
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            ds = factories.DivesiteFactory()
+        self.assertEqual(Divesite.objects.get(pk=ds.pk).geocoding_data, '')
+
+    def test_editing_a_site_without_moving_it_doesnt_geocode(self, mock):
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            ds = factories.DivesiteFactory(latitude=10, longitude=10)
+            ds = Divesite.objects.get(pk=ds.pk)
+            ds.description = 'A new description'
+            ds.latitude = 10.0
+            ds.save()
+        self.assertEqual(mock.call_count, 1)
+
+    def test_moving_a_site_geocodes_it_again(self, mock):
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            slipway = factories.SlipwayFactory(latitude=10, longitude=10)
+            slipway = Slipway.objects.get(pk=slipway.pk)
+            slipway.longitude = 11
+            slipway.save()
+        self.assertEqual(mock.call_count, 2)
+
+    def test_stale_jobs_are_ignored(self, mock):
+        ds = factories.DivesiteFactory(latitude=10, longitude=10)
+        geocoding_queue.process('divesites.Divesite', ds.pk, 20, 20)
+        self.assertEqual(Divesite.objects.get(pk=ds.pk).geocoding_data, '')
+
+
+@patch('divesites.geocoding.fetch_geocoding_data', return_value=GEOCODING_DATA)
+class GeocodingCacheTestCase(APITestCase):
+
+    def setUp(self):
+        geocoding_cache.clear()
+
+    def test_nearby_positions_share_a_result(self, mock):
+        self.assertEqual(geocoding_cache.get_or_fetch(10.0001, 20.0001), GEOCODING_DATA)
+        self.assertEqual(geocoding_cache.get_or_fetch(10.0002, 19.9998), GEOCODING_DATA)
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(geocoding_cache.stats()['hits'], 1)
+        self.assertEqual(geocoding_cache.stats()['misses'], 1)
+
+    def test_results_are_kept_in_the_database(self, mock):
+        geocoding_cache.get_or_fetch(10, 20)
+        self.assertEqual(GeocodingResult.objects.count(), 1)
+        # A fresh process still finds the result
+        geocoding_cache.clear()
+        geocoding_cache.get_or_fetch(10, 20)
+        self.assertEqual(mock.call_count, 1)
+        self.assertEqual(geocoding_cache.stats()['hits'], 1)
+
+    def test_counters_are_thread_safe(self, mock):
+        geocoding_cache.get_or_fetch(10, 20)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda _: geocoding_cache.get(10, 20), range(1000)))
+        self.assertEqual(geocoding_cache.stats()['hits'], 1000)
+
+    def test_precision_is_limited_by_the_table(self, mock):
+        with self.settings(GEOCODING_CACHE_PRECISION=7):
+            with self.assertRaises(ImproperlyConfigured):
+                geocoding_cache.get(10, 20)
+
+    def test_stale_results_are_refetched(self, mock):
+        geocoding_cache.get_or_fetch(10, 20)
+        with self.settings(GEOCODING_CACHE_TTL=0):
+            geocoding_cache.get_or_fetch(10, 20)
+        self.assertEqual(mock.call_count, 2)
+
+    def test_error_responses_are_not_cached(self, mock):
+        mock.return_value = '{"results": [], "status": "OVER_QUERY_LIMIT"}'
+        geocoding_cache.get_or_fetch(10, 20)
+        geocoding_cache.get_or_fetch(10, 20)
+        self.assertEqual(mock.call_count, 2)
+        self.assertFalse(GeocodingResult.objects.exists())
+
+    def test_sites_saved_nearby_share_a_lookup(self, mock):
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            factories.DivesiteFactory(latitude=10.0001, longitude=20.0001)
+            factories.CompressorFactory(latitude=10.0002, longitude=20.0002)
+        self.assertEqual(mock.call_count, 1)
+
+
+@patch('divesites.management.commands.backfill_geocoding.fetch_geocoding_data',
+        return_value=DUBLIN_GEOCODING_DATA)
+class BackfillGeocodingTestCase(APITestCase):
+
+    def setUp(self):
+        geocoding_cache.clear()
+        self.sites = [factories.DivesiteFactory() for _ in range(3)]
+
+    def backfill(self, *args):
+        call_command('backfill_geocoding', '--backoff', '0', *args, stdout=StringIO(), stderr=StringIO())
+
+    def test_sites_without_data_are_geocoded(self, mock):
+        self.backfill()
+        for site in self.sites:
+            site = Divesite.objects.get(pk=site.pk)
+            self.assertEqual(site.country, 'IE')
+
+    def test_failed_requests_are_retried(self, mock):
+        mock.side_effect = [OSError(), '{"status": "OVER_QUERY_LIMIT"}'] + [DUBLIN_GEOCODING_DATA] * 3
+        self.backfill('--workers', '1', '--retries', '2')
+        self.assertEqual(mock.call_count, 5)
+        for site in self.sites:
+            self.assertEqual(Divesite.objects.get(pk=site.pk).country, 'IE')
+
+    def test_giving_up_leaves_site_alone(self, mock):
+        mock.side_effect = OSError()
+        self.backfill('--retries', '1')
+        self.assertEqual(Divesite.objects.get(pk=self.sites[0].pk).geocoding_data, '')
+
+    def test_negative_retries_or_backoff_are_rejected(self, mock):
+        for args in (('--retries', '-1'), ('--backoff', '-1')):
+            with self.assertRaises(CommandError):
+                self.backfill(*args)
+        self.assertFalse(mock.called)
+
+    def test_checkpoint_resumes_after_last_batch(self, mock):
+        sites = sorted(self.sites, key=lambda site: site.pk)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint.json')
+            with open(checkpoint, 'w') as f:
+                json.dump({Divesite._meta.label: str(sites[0].pk)}, f)
+            self.backfill('--checkpoint', checkpoint)
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)[Divesite._meta.label], str(sites[-1].pk))
+        self.assertEqual(Divesite.objects.get(pk=sites[0].pk).geocoding_data, '')
+        self.assertEqual(Divesite.objects.get(pk=sites[1].pk).country, 'IE')
+
+    def test_checkpoint_stops_before_failures(self, mock):
+        sites = sorted(self.sites, key=lambda site: site.pk)
+        mock.side_effect = [DUBLIN_GEOCODING_DATA, OSError(), DUBLIN_GEOCODING_DATA]
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'checkpoint.json')
+            self.backfill('--workers', '1', '--retries', '0', '--checkpoint', checkpoint)
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)[Divesite._meta.label], str(sites[0].pk))
+        self.assertEqual(Divesite.objects.get(pk=sites[2].pk).country, 'IE')
+
+    def test_stale_data_is_refreshed(self, mock):
+        self.backfill()
+        self.assertEqual(mock.call_count, len(self.sites))
+        # Fresh data is left alone...
+        self.backfill()
+        self.assertEqual(mock.call_count, len(self.sites))
+        # ...but once it's older than GEOCODING_CACHE_TTL it's fetched again
+        geocoding_cache.clear()
+        GeocodingResult.objects.update(retrieval_date=timezone.now() - timedelta(days=1))
+        with self.settings(GEOCODING_CACHE_TTL=60):
+            self.backfill()
+        self.assertEqual(mock.call_count, 2 * len(self.sites))
+
+
+class GeocodingDataParsingTestCase(APITestCase):
+
+    def test_fields_are_parsed_from_the_most_specific_result(self):
+        fields = parse_geocoding_data(DUBLIN_GEOCODING_DATA)
+        self.assertEqual(fields, {
+            'country': 'IE',
+            'admin_area_1': 'County Dublin',
+            'locality': 'Howth',
+            'formatted_address': '1 Harbour Road, Howth, Co. Dublin, Ireland',
+            })
+
+    def test_unparseable_data_gives_blank_fields(self):
+        for data in ['', 'not json', '[]', GEOCODING_DATA]:
+            self.assertEqual(set(parse_geocoding_data(data).values()), set(['']))
+
+    @patch('divesites.geocoding.fetch_geocoding_data', return_value=DUBLIN_GEOCODING_DATA)
+    def test_geocoding_a_site_fills_in_parsed_fields(self, mock):
+        geocoding_cache.clear()
+        with self.settings(GEOCODING_SYNCHRONOUS=True):
+            ds = factories.DivesiteFactory()
+        ds = Divesite.objects.get(pk=ds.pk)
+        self.assertEqual(ds.country, 'IE')
+        self.assertEqual(ds.locality, 'Howth')
+
+
+class RegionFilterTestCase(APITestCase):
+
+    def setUp(self):
+        self.irish = factories.DivesiteFactory(country='IE', admin_area_1='County Dublin')
+        factories.DivesiteFactory(country='GB', admin_area_1='England')
+
+    def test_list_can_be_filtered_on_country(self):
+        response = self.client.get(reverse('divesite-list'), {'country': 'ie'})
+        self.assertEqual([_['id'] for _ in response.data], [str(self.irish.id)])
+
+    def test_list_can_be_filtered_on_region(self):
+        response = self.client.get(reverse('divesite-list'), {'region': 'county dublin'})
+        self.assertEqual([_['id'] for _ in response.data], [str(self.irish.id)])
+
+    def test_lists_dont_include_raw_geocoding_data(self):
+        factories.CompressorFactory()
+        for url in [reverse('divesite-list'), reverse('compressor-list')]:
+            response = self.client.get(url)
+            self.assertNotIn('geocoding_data', response.data[0])
+            self.assertIn('country', response.data[0])
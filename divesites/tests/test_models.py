@@ -54,6 +54,47 @@ class DivesiteModelTestCase(APITestCase):
         self.assertEquals(Divesite.objects.get(id=ds.id).get_average_duration(), 2.0)
         self.assertEquals(factories.DivesiteFactory().get_average_duration(), 0)
 
+    def test_averages_dont_query_dives(self):
+        ds = factories.DivesiteFactory()
+        factories.DiveFactory(divesite=ds, depth=10)
+        ds = Divesite.objects.get(id=ds.id)
+        with self.assertNumQueries(0):
+            ds.get_average_maximum_depth()
+            ds.get_average_duration()
+
+    def test_dive_totals_follow_edits_and_deletes(self):
+        ds = factories.DivesiteFactory()
+        dives = [factories.DiveFactory(divesite=ds, depth=10, duration=timedelta(minutes=30)) for _ in range(2)]
+        dives[0].depth = 20
+        dives[0].duration = timedelta(minutes=50)
+        dives[0].save()
+        ds = Divesite.objects.get(id=ds.id)
+        self.assertEquals(ds.get_average_maximum_depth(), 15)
+        self.assertEquals(ds.get_average_duration(), 40)
+        dives[1].delete()
+        ds = Divesite.objects.get(id=ds.id)
+        self.assertEquals(ds.dive_count, 1)
+        self.assertEquals(ds.get_average_maximum_depth(), 20)
+
+    def test_saving_a_site_keeps_dives_logged_since_it_was_loaded(self):
+        ds = factories.DivesiteFactory()
+        stale = Divesite.objects.no_cache().get(id=ds.id)
+        factories.DiveFactory(divesite=ds, depth=10)
+        stale.name = 'Renamed'
+        stale.save()
+        ds = Divesite.objects.no_cache().get(id=ds.id)
+        self.assertEquals(ds.name, 'Renamed')
+        self.assertEquals(ds.dive_count, 1)
+        self.assertEquals(ds.get_average_maximum_depth(), 10)
+
+    def test_moving_a_dive_moves_its_totals(self):
+        old, new = factories.DivesiteFactory(), factories.DivesiteFactory()
+        dive = factories.DiveFactory(divesite=old, depth=10)
+        dive.divesite = new
+        dive.save()
+        self.assertEquals(Divesite.objects.get(id=old.id).dive_count, 0)
+        self.assertEquals(Divesite.objects.get(id=new.id).get_average_maximum_depth(), 10)
+
 
 class DiveModelTestCase(APITestCase):
 
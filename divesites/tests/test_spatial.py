@@ -0,0 +1,157 @@
+import time
+from unittest.mock import patch
+from django.core.urlresolvers import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from divesites import factories, spatial
+from divesites.models import Compressor, Divesite, Slipway
+
+
+class SlipwayIndexTestCase(APITestCase):
+
+    def setUp(self):
+        self.index = spatial.get_index(Slipway)
+        self.index.invalidate()
+
+    def test_within_returns_nearby_slipways_nearest_first(self):
+        far = factories.SlipwayFactory(latitude=53.1, longitude=-6.0)
+        near = factories.SlipwayFactory(latitude=53.01, longitude=-6.0)
+        factories.SlipwayFactory(latitude=-33.0, longitude=151.0)
+        hits = self.index.within(53.0, -6.0, 15)
+        self.assertEqual([pk for _, pk in hits], [near.pk, far.pk])
+
+    def test_nearest_is_quick_with_fewer_points_than_asked_for(self):
+        slipways = [factories.SlipwayFactory(latitude=10, longitude=_) for _ in range(3)]
+        start = time.time()
+        hits = self.index.nearest(-10, 0, 10)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(sorted(pk for _, pk in hits), sorted(_.pk for _ in slipways))
+
+    def test_within_wraps_around_the_antimeridian(self):
+        slipway = factories.SlipwayFactory(latitude=0, longitude=179.99)
+        hits = self.index.within(0, -179.99, 5)
+        self.assertIn(slipway.pk, [pk for _, pk in hits])
+
+    def test_deleted_slipways_are_dropped(self):
+        slipway = factories.SlipwayFactory(latitude=10, longitude=10)
+        slipway.delete()
+        self.assertEqual(self.index.within(10, 10, 1), [])
+
+    def test_moved_slipways_are_reindexed(self):
+        slipway = factories.SlipwayFactory(latitude=10, longitude=10)
+        slipway.latitude = 20
+        slipway.save()
+        self.assertEqual(self.index.within(10, 10, 1), [])
+        self.assertEqual(len(self.index.within(20, 10, 1)), 1)
+
+    def test_saves_that_dont_move_a_slipway_leave_the_index_alone(self):
+        slipway = factories.SlipwayFactory(latitude=10, longitude=10)
+        with patch.object(self.index, 'add') as add:
+            slipway.description = 'Steep'
+            slipway.save()
+            slipway.save(update_fields=['description'])
+            Slipway.objects.get(pk=slipway.pk).save()
+        self.assertFalse(add.called)
+
+
+class NearbySlipwaysViewTestCase(APITestCase):
+
+    def setUp(self):
+        spatial.get_index(Slipway).invalidate()
+
+    def test_only_slipways_in_range_are_returned(self):
+        ds = factories.DivesiteFactory(latitude=53.0, longitude=-6.0)
+        near = factories.SlipwayFactory(latitude=53.05, longitude=-6.0)
+        factories.SlipwayFactory(latitude=54.0, longitude=-6.0)
+        response = self.client.get(reverse('divesite-nearby-slipways', args=[ds.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([_['id'] for _ in response.data], [str(near.id)])
+
+
+class NearbyViewTestCase(APITestCase):
+
+    def setUp(self):
+        for model in (Compressor, Divesite, Slipway):
+            spatial.get_index(model).invalidate()
+        self.divesite = factories.DivesiteFactory(latitude=53.01, longitude=-6.0)
+        self.compressor = factories.CompressorFactory(latitude=53.02, longitude=-6.0)
+        self.slipway = factories.SlipwayFactory(latitude=53.03, longitude=-6.0)
+        factories.SlipwayFactory(latitude=-33.0, longitude=151.0)
+
+    def test_site_nearby_returns_k_nearest_of_that_type(self):
+        response = self.client.get(reverse('slipway-nearby'), {'lat': 53.0, 'lng': -6.0, 'k': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['id'], str(self.slipway.id))
+        self.assertLess(response.data[0]['distance'], 5)
+
+    def test_site_nearby_respects_radius(self):
+        response = self.client.get(reverse('slipway-nearby'), {'lat': 53.0, 'lng': -6.0, 'radius': 1})
+        self.assertEqual(response.data, [])
+
+    def test_site_nearby_requires_a_position(self):
+        response = self.client.get(reverse('divesite-nearby'), {'lat': 53.0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_nearby_mixes_site_types_nearest_first(self):
+        response = self.client.get(reverse('nearby'), {'lat': 53.0, 'lng': -6.0, 'k': 3})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([_['type'] for _ in response.data], ['divesite', 'compressor', 'slipway'])
+
+    def test_nearby_filters_on_types(self):
+        response = self.client.get(reverse('nearby'), {'lat': 53.0, 'lng': -6.0, 'types': 'compressors'})
+        self.assertEqual([_['id'] for _ in response.data], [str(self.compressor.id)])
+
+    def test_nearby_rejects_unknown_types(self):
+        response = self.client.get(reverse('nearby'), {'lat': 53.0, 'lng': -6.0, 'types': 'wrecks'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class DivesiteClustersViewTestCase(APITestCase):
+
+    def setUp(self):
+        spatial.get_cluster_index(Divesite).invalidate()
+        self.dublin = [
+                factories.DivesiteFactory(latitude=53.30, longitude=-6.10),
+                factories.DivesiteFactory(latitude=53.32, longitude=-6.12),
+                ]
+        self.sydney = factories.DivesiteFactory(latitude=-33.8, longitude=151.3)
+        self.url = reverse('divesite-clusters')
+
+    def test_low_zoom_groups_nearby_sites(self):
+        response = self.client.get(self.url, {'zoom': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(_['count'] for _ in response.data), [1, 2])
+        cluster = [_ for _ in response.data if _['count'] == 2][0]
+        self.assertAlmostEqual(cluster['latitude'], 53.31)
+        self.assertAlmostEqual(cluster['longitude'], -6.11)
+
+    def test_clusters_carry_their_bounds(self):
+        response = self.client.get(self.url, {'zoom': 2})
+        cluster = [_ for _ in response.data if _['count'] == 2][0]
+        for actual, expected in zip(cluster['bounds'], [-6.12, 53.30, -6.10, 53.32]):
+            self.assertAlmostEqual(actual, expected)
+
+    def test_bounds_shrink_when_an_edge_site_moves_out(self):
+        self.dublin[1].latitude, self.dublin[1].longitude = -33.9, 151.2
+        self.dublin[1].save()
+        response = self.client.get(self.url, {'zoom': 2})
+        cluster = [_ for _ in response.data if _['latitude'] > 0][0]
+        self.assertEqual(cluster['count'], 1)
+        for actual, expected in zip(cluster['bounds'], [-6.10, 53.30, -6.10, 53.30]):
+            self.assertAlmostEqual(actual, expected)
+
+    def test_single_site_clusters_carry_the_site_id(self):
+        response = self.client.get(self.url, {'zoom': 2, 'bbox': '150,-35,152,-33'})
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(str(response.data[0]['id']), str(self.sydney.id))
+
+    def test_clusters_follow_deletes(self):
+        self.dublin[0].delete()
+        response = self.client.get(self.url, {'zoom': 2})
+        self.assertEqual(sorted(_['count'] for _ in response.data), [1, 1])
+
+    def test_zoom_is_required(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
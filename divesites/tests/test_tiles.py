@@ -0,0 +1,57 @@
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from divesites import factories, tiles
+
+
+class TileMathTestCase(APITestCase):
+
+    def test_tile_for_round_trips_with_tile_edges(self):
+        for z in [0, 3, 10, 16]:
+            x, y = tiles.tile_for(53.3, -6.2, z)
+            west, south, east, north = tiles.tile_edges(z, x, y)
+            self.assertTrue(west <= -6.2 < east)
+            self.assertTrue(south < 53.3 <= north)
+
+
+class TileViewTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.divesite = factories.DivesiteFactory(latitude=53.3, longitude=-6.2)
+        self.slipway = factories.SlipwayFactory(latitude=53.31, longitude=-6.21)
+        factories.CompressorFactory(latitude=-33.8, longitude=151.3)
+        self.z = 10
+        self.x, self.y = tiles.tile_for(53.3, -6.2, self.z)
+        self.url = reverse('tile', args=[self.z, self.x, self.y])
+
+    def test_tile_contains_sites_inside_it(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([_[0] for _ in response.data['divesites']], [str(self.divesite.id)])
+        self.assertEqual([_[0] for _ in response.data['slipways']], [str(self.slipway.id)])
+        self.assertEqual(response.data['compressors'], [])
+
+    def test_tile_is_cached(self):
+        self.client.get(self.url)
+        self.assertIsNotNone(cache.get(tiles.tile_key(self.z, self.x, self.y)))
+
+    def test_saving_a_site_invalidates_its_old_and_new_tiles(self):
+        self.client.get(self.url)
+        self.divesite.latitude = 10
+        self.divesite.save()
+        self.assertIsNone(cache.get(tiles.tile_key(self.z, self.x, self.y)))
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['divesites'], [])
+
+    def test_deleting_a_site_invalidates_its_tile(self):
+        self.client.get(self.url)
+        self.slipway.delete()
+        response = self.client.get(self.url)
+        self.assertEqual(response.data['slipways'], [])
+
+    def test_tile_outside_the_map_returns_404(self):
+        response = self.client.get(reverse('tile', args=[1, 2, 0]))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
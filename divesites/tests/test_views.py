@@ -1,9 +1,13 @@
+import json
 from decimal import Decimal
+from unittest.mock import patch
 from django.utils import timezone
 from datetime import timedelta
 import random
 from django.utils import timezone
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 import factory
 from faker import Factory as FakerFactory
 from rest_framework import status
@@ -84,12 +88,61 @@ class DivesiteCreateTestCase(APITestCase):
 
     def test_divesite_cant_be_too_close_to_existing_divesite(self):
         ds = DivesiteFactory()
-        self.data['latitude'] = ds.latitude + Decimal(0.0009)
-        self.data['longitude'] = ds.longitude + Decimal(0.0009)
+        # Less than 80 m away, wherever the site is
+        self.data['latitude'] = ds.latitude + Decimal(0.0005)
+        self.data['longitude'] = ds.longitude + Decimal(0.0005)
         self.client.force_authenticate(self.u)
         result = self.client.post(self.url, self.data)
         self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_distance_check_uses_true_distance(self):
+        # At 70N, 0.002 degrees of longitude is only about 76 m
+        DivesiteFactory(latitude=70, longitude=20)
+        self.data['latitude'] = 70
+        self.data['longitude'] = 20.002
+        self.client.force_authenticate(self.u)
+        result = self.client.post(self.url, self.data)
+        self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
+        # ...but 0.0015 degrees of latitude is about 167 m
+        self.data['latitude'] = 70.0015
+        self.data['longitude'] = 20
+        result = self.client.post(self.url, self.data)
+        self.assertEqual(result.status_code, status.HTTP_201_CREATED)
+
+    def test_distance_check_radius_is_configurable(self):
+        DivesiteFactory(latitude=10, longitude=10)
+        self.data['latitude'] = 10.0015
+        self.data['longitude'] = 10
+        self.client.force_authenticate(self.u)
+        with self.settings(MINIMUM_SITE_SEPARATION=500):
+            result = self.client.post(self.url, self.data)
+        self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CompressorSlipwayCreateTestCase(APITestCase):
+
+    def setUp(self):
+        self.u = UserFactory()
+        self.client.force_authenticate(self.u)
+
+    def test_compressor_cant_be_too_close_to_existing_compressor(self):
+        factories.CompressorFactory(latitude=10, longitude=10)
+        data = {'name': 'Compressor', 'latitude': 10.0005, 'longitude': 10}
+        result = self.client.post(reverse('compressor-list'), data)
+        self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_slipway_cant_be_too_close_to_existing_slipway(self):
+        factories.SlipwayFactory(latitude=10, longitude=10)
+        data = {'name': 'Slipway', 'latitude': 10.0005, 'longitude': 10}
+        result = self.client.post(reverse('slipway-list'), data)
+        self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_slipway_can_be_close_to_a_compressor(self):
+        factories.CompressorFactory(latitude=10, longitude=10)
+        data = {'name': 'Slipway', 'latitude': 10.0005, 'longitude': 10}
+        result = self.client.post(reverse('slipway-list'), data)
+        self.assertEqual(result.status_code, status.HTTP_201_CREATED)
+
 
 class DivesiteUpdateTestCase(APITestCase):
 
@@ -115,8 +168,8 @@ class DivesiteUpdateTestCase(APITestCase):
     def test_divesite_cant_be_too_close_to_existing_divesite(self):
         ds = DivesiteFactory()
         data = {}
-        data['latitude'] = ds.latitude + Decimal(0.0009)
-        data['longitude'] = ds.longitude + Decimal(0.0009)
+        data['latitude'] = ds.latitude + Decimal(0.0005)
+        data['longitude'] = ds.longitude + Decimal(0.0005)
         self.client.force_authenticate(self.user)
         result = self.client.patch(self.url, data)
         self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
@@ -307,3 +360,117 @@ class DiveUpdateTestCase(APITestCase):
         # TODO: view should probably throw exception instead of returning 200
         self.assertEqual(Dive.objects.get(id=self.dive.id).diver, self.user)
 
+
+
+class SiteBoundingBoxTestCase(APITestCase):
+
+    def setUp(self):
+        self.inside = factories.DivesiteFactory(latitude=53.3, longitude=-6.2)
+        self.outside = factories.DivesiteFactory(latitude=51.9, longitude=-8.5)
+
+    def test_bbox_restricts_list_to_viewport(self):
+        result = self.client.get(reverse('divesite-list'), {'bbox': '-7,53,-6,54'})
+        self.assertEqual(result.status_code, status.HTTP_200_OK)
+        self.assertEqual([_['id'] for _ in result.data], [str(self.inside.id)])
+
+    def test_bbox_can_cross_the_antimeridian(self):
+        ds = factories.DivesiteFactory(latitude=-17.7, longitude=179.5)
+        result = self.client.get(reverse('divesite-list'), {'bbox': '179,-18,-179,-17'})
+        self.assertEqual([_['id'] for _ in result.data], [str(ds.id)])
+
+    def test_bbox_applies_to_compressors_and_slipways(self):
+        compressor = factories.CompressorFactory(latitude=53.3, longitude=-6.2)
+        factories.CompressorFactory(latitude=10, longitude=10)
+        slipway = factories.SlipwayFactory(latitude=53.3, longitude=-6.2)
+        factories.SlipwayFactory(latitude=10, longitude=10)
+        result = self.client.get(reverse('compressor-list'), {'bbox': '-7,53,-6,54'})
+        self.assertEqual([_['id'] for _ in result.data], [str(compressor.id)])
+        result = self.client.get(reverse('slipway-list'), {'bbox': '-7,53,-6,54'})
+        self.assertEqual([_['id'] for _ in result.data], [str(slipway.id)])
+
+    def test_malformed_bbox_returns_400(self):
+        for bbox in ['-7,53,-6', 'a,b,c,d', '-7,54,-6,53']:
+            result = self.client.get(reverse('divesite-list'), {'bbox': bbox})
+            self.assertEqual(result.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SiteListQueryCountTestCase(APITestCase):
+
+    def count_list_queries(self, route):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(route))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_list_queries_dont_grow_with_the_number_of_sites(self):
+        for route, factory in [
+                ('compressor-list', factories.CompressorFactory),
+                ('divesite-list', factories.DivesiteFactory),
+                ('slipway-list', factories.SlipwayFactory),
+                ]:
+            factory()
+            few = self.count_list_queries(route)
+            for _ in range(NUM_SITES):
+                factory()
+            self.assertEqual(self.count_list_queries(route), few)
+
+
+class SiteListPaginationTestCase(APITestCase):
+
+    def setUp(self):
+        self.divesites = [factories.DivesiteFactory() for _ in range(NUM_SITES)]
+
+    def test_lists_are_unpaginated_by_default(self):
+        response = self.client.get(reverse('divesite-list'))
+        self.assertEqual(len(response.data), NUM_SITES)
+
+    def test_page_size_paginates_with_a_cursor(self):
+        response = self.client.get(reverse('divesite-list'), {'page_size': 3})
+        self.assertEqual(len(response.data['results']), 3)
+        ids = [_['id'] for _ in response.data['results']]
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), NUM_SITES - 3)
+        ids += [_['id'] for _ in response.data['results']]
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(sorted(ids), sorted(str(_.id) for _ in self.divesites))
+
+    def test_invalid_page_size_uses_the_default(self):
+        response = self.client.get(reverse('divesite-list'), {'page_size': 0})
+        self.assertEqual(len(response.data['results']), NUM_SITES)
+        self.assertIsNone(response.data['next'])
+
+    def test_stream_returns_every_site(self):
+        with patch('divesites.views.STREAM_BATCH_SIZE', 3):
+            response = self.client.get(reverse('divesite-list'), {'stream': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual(sorted(_['id'] for _ in data), sorted(str(_.id) for _ in self.divesites))
+
+
+class SparseFieldsetTestCase(APITestCase):
+
+    def setUp(self):
+        self.divesite = factories.DivesiteFactory()
+        factories.DiveFactory(divesite=self.divesite)
+
+    def test_fields_limits_the_response(self):
+        response = self.client.get(reverse('divesite-list'), {'fields': 'id,name,latitude,longitude'})
+        self.assertEqual(set(response.data[0].keys()), {'id', 'name', 'latitude', 'longitude'})
+
+    def test_exclude_leaves_fields_out(self):
+        response = self.client.get(reverse('divesite-detail', args=[self.divesite.id]), {'exclude': 'dives,owner'})
+        self.assertNotIn('dives', response.data)
+        self.assertNotIn('owner', response.data)
+        self.assertIn('name', response.data)
+
+    def test_skipped_relations_arent_fetched(self):
+        url = reverse('divesite-list')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {'fields': 'id,name'})
+        self.assertFalse(any('auth_user' in _['sql'] for _ in queries.captured_queries))
+
+    def test_writes_ignore_fields(self):
+        self.client.force_authenticate(self.divesite.owner)
+        response = self.client.patch(reverse('divesite-detail', args=[self.divesite.id]) + '?fields=id',
+                {'name': 'Renamed'})
+        self.assertEqual(response.data['name'], 'Renamed')
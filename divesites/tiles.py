@@ -0,0 +1,90 @@
+"""
+Web-mercator tiles of site positions.
+
+A tile holds every compressor, divesite and slipway inside it as packed
+[id, name, latitude, longitude] arrays. Tiles at zoom levels up to
+MAX_CACHED_TILE_ZOOM are cached under their z/x/y key until a site inside
+them is saved or deleted.
+"""
+import math
+from django.apps import apps
+from django.core.cache import cache
+from .spatial import mercator
+
+MAX_TILE_ZOOM = 22
+MAX_CACHED_TILE_ZOOM = 16
+# Site types in a tile, keyed on their name in the payload. (This module
+# is imported by divesites.models, so the models are looked up by label.)
+TILE_SITE_TYPES = (
+        ('compressors', 'divesites.Compressor'),
+        ('divesites', 'divesites.Divesite'),
+        ('slipways', 'divesites.Slipway'),
+        )
+
+
+def tile_key(z, x, y):
+    return 'tile:%d:%d:%d' % (z, x, y)
+
+
+def tile_for(latitude, longitude, z):
+    """Return the (x, y) of the tile at zoom z containing a position."""
+    size = 2 ** z
+    x, y = mercator(float(latitude), float(longitude))
+    return min(int(x * size), size - 1), min(int(y * size), size - 1)
+
+
+def tile_edges(z, x, y):
+    """Return the (west, south, east, north) edges of a tile, in degrees."""
+    size = 2 ** z
+
+    def latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / size))))
+
+    return x / size * 360 - 180, latitude(y + 1), (x + 1) / size * 360 - 180, latitude(y)
+
+
+def _sites_in_tile(model, z, x, y):
+    west, south, east, north = tile_edges(z, x, y)
+    size = 2 ** z
+    # Match tile_for: tiles include their west and north edges, and the
+    # tiles around the edge of the map take in everything beyond it
+    queryset = model.objects.no_cache().filter(longitude__gte=west)
+    if x < size - 1:
+        queryset = queryset.filter(longitude__lt=east)
+    if y > 0:
+        queryset = queryset.filter(latitude__lte=north)
+    if y < size - 1:
+        queryset = queryset.filter(latitude__gt=south)
+    return [
+            [str(pk), name, round(float(latitude), 6), round(float(longitude), 6)]
+            for pk, name, latitude, longitude
+            in queryset.values_list('pk', 'name', 'latitude', 'longitude')
+            ]
+
+
+def build_tile(z, x, y):
+    tile = {'z': z, 'x': x, 'y': y}
+    for name, label in TILE_SITE_TYPES:
+        tile[name] = _sites_in_tile(apps.get_model(label), z, x, y)
+    return tile
+
+
+def get_tile(z, x, y):
+    """Return the payload for a tile, from the cache if we can."""
+    if z > MAX_CACHED_TILE_ZOOM:
+        return build_tile(z, x, y)
+    key = tile_key(z, x, y)
+    tile = cache.get(key)
+    if tile is None:
+        tile = build_tile(z, x, y)
+        cache.set(key, tile, None)
+    return tile
+
+
+def invalidate_tiles(positions):
+    """Drop the cached tiles containing any of the given (lat, lng) positions."""
+    keys = set()
+    for latitude, longitude in positions:
+        for z in range(MAX_CACHED_TILE_ZOOM + 1):
+            keys.add(tile_key(z, *tile_for(latitude, longitude, z)))
+    cache.delete_many(list(keys))
@@ -1,28 +1,164 @@
 from actstream import action
 from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from haversine import haversine
 from rest_framework import mixins
 from rest_framework import viewsets
 from rest_framework import status
-from rest_framework.decorators import detail_route, list_route
-from rest_framework.exceptions import NotFound
+from rest_framework.decorators import api_view, detail_route, list_route
+from rest_framework.exceptions import NotFound, ValidationError as RequestValidationError
 from rest_framework.permissions import IsAuthenticatedOrReadOnly
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from .serializers import CompressorSerializer, DiveSerializer, DiveListSerializer,  DivesiteSerializer, DivesiteListSerializer, SlipwaySerializer
+from .serializers import CompressorSerializer, CompressorListSerializer, DiveSerializer, DiveListSerializer,  DivesiteSerializer, DivesiteListSerializer, SlipwaySerializer, SlipwayListSerializer
 from .models import Compressor, Dive, Divesite, Slipway
+from .filters import BoundingBoxFilter, RegionFilter
 from .permissions import IsDiverOrReadOnly, IsOwnerOrReadOnly
+from . import spatial, tiles
+from dsapi.conditional import PROFILE_TAGS, ConditionalGetMixin, conditional
+from dsapi.pagination import CursorPagination
+from dsapi.serializers import is_field_requested
 from comments.models import DivesiteComment, SlipwayComment, CompressorComment
 from comments.serializers import DivesiteCommentSerializer, CompressorCommentSerializer, SlipwayCommentSerializer 
 from images.models import Image
 from images.serializers import ImageSerializer
 
-class BaseSiteViewSet(viewsets.ModelViewSet):
+# Default and maximum number of results for a nearby-sites query
+NEARBY_DEFAULT_K = 10
+NEARBY_MAX_K = 100
+# Number of sites fetched from the DB at a time for a streamed list
+STREAM_BATCH_SIZE = 500
+
+
+def get_nearby_parameters(request):
+    """
+    Parse the lat, lng, radius (km) and k query parameters for a
+    nearby-sites query; lat and lng are required.
+    """
+    params = request.query_params
+    try:
+        latitude = float(params['lat'])
+        longitude = float(params['lng'])
+        radius = float(params['radius']) if 'radius' in params else None
+        k = int(params.get('k', NEARBY_DEFAULT_K))
+    except KeyError as e:
+        raise RequestValidationError({e.args[0]: 'This parameter is required.'})
+    except ValueError:
+        raise RequestValidationError('lat, lng, radius and k must be numbers')
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise RequestValidationError('lat/lng is not a valid position')
+    if radius is not None and radius <= 0:
+        raise RequestValidationError({'radius': 'Must be greater than 0.'})
+    if not 0 < k <= NEARBY_MAX_K:
+        raise RequestValidationError({'k': 'Must be between 1 and %d.' % NEARBY_MAX_K})
+    return latitude, longitude, radius, k
+
+
+def find_nearby_sites(model, queryset, latitude, longitude, k, radius=None):
+    """Return up to k sites from queryset nearest to the given position."""
+    return spatial.get_index(model).find(queryset, latitude, longitude, k, radius)
+
+
+def serialize_nearby_sites(request, sites, serializer_class, **extra):
+    data = serializer_class(sites, many=True, context={'request': request}).data
+    for site, item in zip(sites, data):
+        item['distance'] = round(site.distance, 3)
+        item.update(extra)
+    return data
+
+
+class SitePaginator(CursorPagination):
+    # Keyset pagination, newest sites first, so that page n + 1 costs the
+    # same as page 1 however big the table gets
+    ordering = '-creation_date'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+def stream_sites(request, queryset, serializer_class, batch_size):
+    """
+    Yield a JSON array of the serialized sites in queryset, a batch at a
+    time, walking the table in primary-key order so that no more than
+    batch_size sites are in memory at once.
+    """
+    renderer = JSONRenderer()
+    queryset = queryset.no_cache().order_by('pk')
+    yield b'['
+    last_pk = None
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        batch = list(batch[:batch_size])
+        if not batch:
+            break
+        # Render the batch as an array and strip the brackets off, so that
+        # batches can be joined into one array
+        serializer = serializer_class(batch, many=True, context={'request': request})
+        chunk = renderer.render(serializer.data)[1:-1]
+        yield chunk if last_pk is None else b',' + chunk
+        last_pk = batch[-1].pk
+    yield b']'
+
+
+class BaseSiteViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
 
     # The default permission classes are
     # (a) safe methods only if unauthenticated;
     # (b) safe methods only if not the owner of the site
     permission_classes = (IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly,)
+    # Lists can be restricted to a map viewport with ?bbox=, and to a
+    # country or region with ?country= and ?region=
+    filter_backends = (BoundingBoxFilter, RegionFilter,)
+    # Subclasses can use a lighter serializer when sending many sites
+    list_serializer_class = None
+    # Everything the serializers show about a site's owner, fetched in the
+    # same query as the sites themselves (unless the client has left the
+    # owner out with ?fields= or ?exclude=)
+    list_select_related = ('owner__profile', 'owner__profile_image',)
+    # Lists are paginated only if the client asks, with ?page_size= (or
+    # by following a next/previous link), so that existing clients still
+    # get a plain array
+    pagination_class = SitePaginator
+
+    def get_queryset(self):
+        queryset = super(BaseSiteViewSet, self).get_queryset()
+        if self.action in ('list', 'nearby', 'retrieve') and is_field_requested(self.request, 'owner'):
+            queryset = queryset.select_related(*self.list_select_related)
+        return queryset
+
+    def get_list_serializer_class(self):
+        return self.list_serializer_class or self.serializer_class
+
+    def get_serializer_class(self):
+        if self.action == 'list':
+            return self.get_list_serializer_class()
+        return super(BaseSiteViewSet, self).get_serializer_class()
+
+    def paginate_queryset(self, queryset):
+        params = self.request.query_params
+        if 'page_size' not in params and 'cursor' not in params:
+            return None
+        return super(BaseSiteViewSet, self).paginate_queryset(queryset)
+
+    def list(self, request, *args, **kwargs):
+        # With ?stream=1, send every matching site as a JSON array that's
+        # serialized as it's sent, rather than building it up in memory
+        if request.query_params.get('stream') in ('1', 'true'):
+            queryset = self.filter_queryset(self.get_queryset())
+            return StreamingHttpResponse(
+                    stream_sites(request, queryset, self.get_list_serializer_class(), STREAM_BATCH_SIZE),
+                    content_type='application/json')
+        return super(BaseSiteViewSet, self).list(request, *args, **kwargs)
+
+    @list_route(methods=['get'])
+    def nearby(self, request):
+        # Return the k sites of this type nearest to ?lat=&lng=, optionally
+        # limited to ?radius= km
+        latitude, longitude, radius, k = get_nearby_parameters(request)
+        model = self.get_queryset().model
+        sites = find_nearby_sites(model, self.get_queryset(), latitude, longitude, k, radius)
+        return Response(serialize_nearby_sites(request, sites, self.get_list_serializer_class()))
 
     @detail_route(methods=['get', 'post', 'delete'])
     def header_image(self, request, pk):
@@ -79,16 +215,51 @@ class DivesiteViewSet(BaseSiteViewSet):
 
     queryset = Divesite.objects.all()
     serializer_class = DivesiteSerializer
+    list_serializer_class = DivesiteListSerializer
+    # Divesites show their dives (or at least their average depth and
+    # duration) along with who logged them. Everything about one site
+    # depends on the site itself too, if only to 404 once it's deleted.
+    version_tags = {
+            'list': ('divesites.divesite', 'divesites.dive',) + PROFILE_TAGS,
+            'retrieve': ('divesites.divesite:{pk}', 'divesites.dive:divesite={pk}',) + PROFILE_TAGS,
+            'nearby': ('divesites.divesite', 'divesites.dive',) + PROFILE_TAGS,
+            'clusters': ('divesites.divesite',),
+            'comments': ('divesites.divesite:{pk}', 'comments.divesitecomment:divesite={pk}',) + PROFILE_TAGS,
+            'dives': ('divesites.divesite:{pk}', 'divesites.dive:divesite={pk}',) + PROFILE_TAGS,
+            'header_image': ('divesites.divesite:{pk}', 'images.image:object_id={pk}',) + PROFILE_TAGS,
+            'nearby_slipways': ('divesites.divesite:{pk}', 'divesites.slipway',) + PROFILE_TAGS,
+            }
+
+    def get_queryset(self):
+        queryset = super(DivesiteViewSet, self).get_queryset()
+        # The detail view lists the site's dives and who logged them
+        if self.action == 'retrieve' and is_field_requested(self.request, 'dives'):
+            dives = Dive.objects.select_related('diver__profile', 'diver__profile_image')
+            queryset = queryset.prefetch_related(Prefetch('dives', queryset=dives))
+        return queryset
 
     def perform_create(self, serializer):
         # Get the user from the request
         user = self.request.user
         instance = serializer.save(owner=user)
 
-    def list(self, request):
-        queryset = self.get_queryset()
-        serializer = DivesiteListSerializer(queryset, many=True)
-        return Response(serializer.data)
+    @list_route(methods=['get'])
+    def clusters(self, request):
+        # Return map clusters of divesites at ?zoom=, optionally only in
+        # the ?bbox= viewport
+        try:
+            zoom = int(request.query_params['zoom'])
+        except KeyError:
+            raise RequestValidationError({'zoom': 'This parameter is required.'})
+        except ValueError:
+            raise RequestValidationError({'zoom': 'Must be an integer.'})
+        if zoom < 0:
+            raise RequestValidationError({'zoom': 'Must not be negative.'})
+        bbox = BoundingBoxFilter().get_bounding_box(request)
+        if bbox is not None:
+            bbox = tuple(float(_) for _ in bbox)
+        clusters = spatial.get_cluster_index(Divesite).clusters(zoom, bbox)
+        return Response(clusters)
 
     @detail_route(methods=['get'])
     def comments(self, request, pk):
@@ -112,25 +283,13 @@ class DivesiteViewSet(BaseSiteViewSet):
     def nearby_slipways(self, request, pk):
         # Return nearby slipways for this divesite
         NEARBY_SLIPWAY_KM_LIMIT = 15
-        # XXX: this is going to hit the DB for *all* slipways, then
-        # sort them on haversine, then return the top n results.
-        # In other words, it's an expensive query.
-        # With GeoDjango there's probably a better way to do it,
-        # but that'll require SaaS support for GeoDjango
         divesite = get_object_or_404(self.get_queryset(), pk=pk)
-        slipways = Slipway.objects.all()
-        # Sort the slipways on Haversine distance from this
-        # divesite
-        key = lambda slipway: haversine(
-                (divesite.latitude, divesite.longitude),
-                (slipway.latitude, slipway.longitude)
-                )
-        slipways = [slipway for slipway in sorted(slipways, key=key) \
-                if haversine(
-                (divesite.latitude, divesite.longitude),
-                (slipway.latitude, slipway.longitude)
-                    ) <= NEARBY_SLIPWAY_KM_LIMIT]
-        serializer = SlipwaySerializer(slipways, many=True)
+        # Ask the spatial index for the slipways within range, nearest
+        # first; only those rows are then fetched from the DB
+        index = spatial.get_index(Slipway)
+        hits = index.within(divesite.latitude, divesite.longitude, NEARBY_SLIPWAY_KM_LIMIT)
+        slipways = index.resolve(Slipway.objects.all(), hits)
+        serializer = SlipwaySerializer(slipways, many=True, context={'request': request})
         return Response(serializer.data)
 
 
@@ -158,6 +317,14 @@ class DiveViewSet(viewsets.GenericViewSet,
 class CompressorViewSet(BaseSiteViewSet):
     queryset = Compressor.objects.all()
     serializer_class = CompressorSerializer
+    list_serializer_class = CompressorListSerializer
+    version_tags = {
+            'list': ('divesites.compressor',) + PROFILE_TAGS,
+            'retrieve': ('divesites.compressor:{pk}',) + PROFILE_TAGS,
+            'nearby': ('divesites.compressor',) + PROFILE_TAGS,
+            'comments': ('divesites.compressor:{pk}', 'comments.compressorcomment:compressor={pk}',) + PROFILE_TAGS,
+            'header_image': ('divesites.compressor:{pk}', 'images.image:object_id={pk}',) + PROFILE_TAGS,
+            }
 
     def perform_create(self, serializer):
         # Get the user from the request
@@ -176,6 +343,14 @@ class CompressorViewSet(BaseSiteViewSet):
 class SlipwayViewSet(BaseSiteViewSet):
     queryset = Slipway.objects.all()
     serializer_class = SlipwaySerializer
+    list_serializer_class = SlipwayListSerializer
+    version_tags = {
+            'list': ('divesites.slipway',) + PROFILE_TAGS,
+            'retrieve': ('divesites.slipway:{pk}',) + PROFILE_TAGS,
+            'nearby': ('divesites.slipway',) + PROFILE_TAGS,
+            'comments': ('divesites.slipway:{pk}', 'comments.slipwaycomment:slipway={pk}',) + PROFILE_TAGS,
+            'header_image': ('divesites.slipway:{pk}', 'images.image:object_id={pk}',) + PROFILE_TAGS,
+            }
 
     def perform_create(self, serializer):
         # Get the user from the request
@@ -188,3 +363,52 @@ class SlipwayViewSet(BaseSiteViewSet):
         queryset = SlipwayComment.objects.filter(slipway=self.get_object())
         serializer = SlipwayCommentSerializer(queryset, many=True)
         return Response(serializer.data)
+
+
+# Site types that a top-level nearby query can ask for, keyed on the
+# names used in ?types=
+NEARBY_SITE_TYPES = {
+        'compressors': (Compressor, CompressorListSerializer),
+        'divesites': (Divesite, DivesiteListSerializer),
+        'slipways': (Slipway, SlipwayListSerializer),
+        }
+
+
+@api_view(['GET'])
+@conditional('divesites.compressor', 'divesites.dive', 'divesites.divesite', 'divesites.slipway', *PROFILE_TAGS)
+def nearby(request):
+    """
+    Return the k sites of any type (or of the comma-separated ?types=)
+    nearest to ?lat=&lng=, optionally limited to ?radius= km. Each site
+    is tagged with its type and its distance in km.
+    """
+    latitude, longitude, radius, k = get_nearby_parameters(request)
+    types = request.query_params.get('types')
+    types = types.split(',') if types else sorted(NEARBY_SITE_TYPES.keys())
+    unknown = set(types) - set(NEARBY_SITE_TYPES.keys())
+    if unknown:
+        raise RequestValidationError({'types': 'Unknown site types: %s' % ', '.join(sorted(unknown))})
+    results = []
+    for site_type in types:
+        model, serializer_class = NEARBY_SITE_TYPES[site_type]
+        # The k nearest overall are among the k nearest of each type
+        queryset = model.objects.all()
+        if is_field_requested(request, 'owner'):
+            queryset = queryset.select_related(*BaseSiteViewSet.list_select_related)
+        sites = find_nearby_sites(model, queryset, latitude, longitude, k, radius)
+        results += serialize_nearby_sites(request, sites, serializer_class, type=model._meta.model_name)
+    results.sort(key=lambda item: item['distance'])
+    return Response(results[:k])
+
+
+@api_view(['GET'])
+@conditional('divesites.compressor', 'divesites.divesite', 'divesites.slipway')
+def tile(request, z, x, y):
+    """
+    Return every site in web-mercator tile z/x/y as packed
+    [id, name, latitude, longitude] arrays, one list per site type.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if z > tiles.MAX_TILE_ZOOM or x >= 2 ** z or y >= 2 ** z:
+        raise Http404
+    return Response(tiles.get_tile(z, x, y))
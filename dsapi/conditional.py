@@ -0,0 +1,259 @@
+import hashlib
+import time
+from functools import wraps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.http import HttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.response import Response
+
+# Models whose changes show up wherever a user is shown (a name and a
+# profile image are sent alongside sites, dives, comments and images)
+PROFILE_TAGS = ('profiles.profile', 'images.userprofileimage',)
+# Fields that no response shows, so that saving only them (as logging in
+# does) doesn't count as a change
+UNTRACKED_FIELDS = frozenset(['last_login'])
+
+
+def version_key(tag):
+    return 'version:%s' % tag
+
+
+def object_tag(tag, pk):
+    """Return the tag for one instance of the model tagged tag."""
+    return '%s:%s' % (tag, pk)
+
+
+def relation_tag(tag, field, value):
+    """
+    Return the tag for the instances of the model tagged tag whose field
+    is value (e.g. 'divesites.dive:divesite=<pk>' for a divesite's dives).
+    """
+    return '%s:%s=%s' % (tag, field, value)
+
+
+def touch(*tags):
+    """Record that whatever tags stand for has changed."""
+    now = time.time()
+    cache.set_many(dict((version_key(tag), now) for tag in tags), None)
+
+
+def changed(*tags):
+    """
+    touch() tags straight away, and again after commit so that a response
+    built from the data from before then isn't stamped as current.
+    """
+    touch(*tags)
+    transaction.on_commit(lambda: touch(*tags))
+
+
+def get_versions(tags):
+    """
+    Return a list of the version stamps for tags. A tag the cache doesn't
+    know about (e.g. after a restart) is stamped now, so that responses
+    from before can't be mistaken for current ones.
+    """
+    keys = [version_key(tag) for tag in tags]
+    versions = cache.get_many(keys)
+    missing = [tag for tag, key in zip(tags, keys) if key not in versions]
+    if missing:
+        touch(*missing)
+        versions.update(cache.get_many([version_key(tag) for tag in missing]))
+    return [versions.get(key, time.time()) for key in keys]
+
+
+def track(model, *relations):
+    """
+    Bump the versions of model's tag (its app_label.model_name), of the
+    instance's own tag (see object_tag()) and of its tag for each of the
+    fields named in relations (see relation_tag(); both the value the
+    field was loaded with and the one it's saved with count) whenever an
+    instance is saved or deleted. Saves of UNTRACKED_FIELDS alone don't
+    count.
+    """
+    tag = model._meta.label_lower
+    fields = [(name, model._meta.get_field(name).attname) for name in relations]
+    def remember_relations(sender, instance, **kwargs):
+        instance._original_relations = dict(
+                (name, instance.__dict__.get(attname)) for name, attname in fields)
+    def model_changed(sender, instance, update_fields=None, **kwargs):
+        if update_fields is not None and update_fields <= UNTRACKED_FIELDS:
+            return
+        tags = set([tag, object_tag(tag, instance.pk)])
+        for name, attname in fields:
+            for value in (instance._original_relations[name], instance.__dict__.get(attname)):
+                if value is not None:
+                    tags.add(relation_tag(tag, name, value))
+        remember_relations(sender, instance)
+        changed(*tags)
+    post_init.connect(remember_relations, sender=model, weak=False, dispatch_uid=version_key(tag))
+    post_save.connect(model_changed, sender=model, weak=False, dispatch_uid=version_key(tag))
+    post_delete.connect(model_changed, sender=model, weak=False, dispatch_uid=version_key(tag))
+
+
+class NotModified(APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+
+def get_validators(request, tags):
+    """
+    Return an ETag and a Last-Modified timestamp for a response to request
+    that depends on tags. The ETag also covers the URL, the requested
+    format and the user, since those change what's sent.
+
+    Last-Modified only has whole seconds, so it's None until the second of
+    the latest change is over: otherwise a client could be sent one that a
+    later change in the same second wouldn't alter.
+    """
+    versions = get_versions(tags)
+    user = request.user.pk if request.user.is_authenticated() else ''
+    digest = hashlib.md5()
+    for part in [request.get_full_path(), request.META.get('HTTP_ACCEPT', ''), user] + versions:
+        digest.update(('%s\n' % part).encode('utf-8'))
+    last_modified = int(max(versions))
+    if time.time() < last_modified + 1:
+        last_modified = None
+    return quote_etag(digest.hexdigest()), last_modified
+
+
+def is_not_modified(request, etag, last_modified):
+    """Return True if the client's copy is current, by RFC 7232 rules."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = [_.strip() for _ in if_none_match.split(',')]
+        return '*' in etags or etag in etags
+    if last_modified is None:
+        return False
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and last_modified <= if_modified_since
+
+
+def set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+# Responses to anonymous requests are the same for everybody, so they're
+# cached whole, under their ETag: when anything they depend on changes, so
+# does the key.
+
+def response_cache_key(etag):
+    return 'response:%s' % etag.strip('"')
+
+
+def get_cached_response(request, etag):
+    if request.user.is_authenticated():
+        return None
+    cached = cache.get(response_cache_key(etag))
+    if cached is None:
+        return None
+    content, content_type = cached
+    return HttpResponse(content, content_type=content_type)
+
+
+def cache_response(request, response, etag):
+    """Cache response once it's rendered, if it can be shared."""
+    if request.user.is_authenticated() or request.method != 'GET':
+        return
+    if not isinstance(response, Response) or response.status_code != status.HTTP_200_OK:
+        return
+    def store(response):
+        cache.set(response_cache_key(etag), (response.content, response['Content-Type']),
+                settings.RESPONSE_CACHE_TIMEOUT)
+    response.add_post_render_callback(store)
+
+
+class CachedResponse(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+class ConditionalGetMixin(object):
+    """
+    Answer GETs with 304 Not Modified, before any work is done, if the
+    client already has the current version of the response; otherwise send
+    ETag and Last-Modified headers with it. Anonymous responses are served
+    from (and saved to) the response cache.
+
+    version_tags maps each action that should do this to the tags (see
+    track()) that its responses depend on. Tags can take the URL's keyword
+    arguments, e.g. 'divesites.dive:divesite={pk}' for the dives at the
+    divesite being asked for; see get_version_tag_kwargs().
+    """
+    version_tags = {}
+
+    def get_version_tag_kwargs(self):
+        kwargs = dict(self.kwargs)
+        # Tags are keyed on primary keys in their canonical form, which the
+        # one in the URL needn't be in (e.g. an upper-case UUID)
+        if 'pk' in kwargs:
+            try:
+                kwargs['pk'] = self.get_queryset().model._meta.pk.to_python(kwargs['pk'])
+            except ValidationError:
+                kwargs['pk'] = None
+        return kwargs
+
+    def get_version_tags(self):
+        tags = self.version_tags.get(getattr(self, 'action', None))
+        if not tags:
+            return ()
+        kwargs = self.get_version_tag_kwargs()
+        return [tag.format(**kwargs) for tag in tags]
+
+    def initial(self, request, *args, **kwargs):
+        super(ConditionalGetMixin, self).initial(request, *args, **kwargs)
+        self.validators = None
+        tags = self.get_version_tags() if request.method in ('GET', 'HEAD') else ()
+        if tags:
+            self.validators = get_validators(request, tags)
+            if is_not_modified(request, *self.validators):
+                raise NotModified()
+            response = get_cached_response(request, self.validators[0])
+            if response is not None:
+                raise CachedResponse(response)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), *self.validators)
+        if isinstance(exc, CachedResponse):
+            return exc.response
+        return super(ConditionalGetMixin, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(ConditionalGetMixin, self).finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'validators', None) and response.status_code == status.HTTP_200_OK:
+            set_validators(response, *self.validators)
+            cache_response(request, response, self.validators[0])
+        return response
+
+
+def conditional(*tags):
+    """
+    Do what ConditionalGetMixin does for an @api_view function view whose
+    responses depend on tags (which can take the view's keyword arguments).
+    Apply it underneath @api_view.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            validators = get_validators(request, [tag.format(**kwargs) for tag in tags])
+            if is_not_modified(request, *validators):
+                return set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), *validators)
+            response = get_cached_response(request, validators[0])
+            if response is None:
+                response = view(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                set_validators(response, *validators)
+                cache_response(request, response, validators[0])
+            return response
+        return wrapped
+    return decorator
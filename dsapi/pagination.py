@@ -0,0 +1,24 @@
+from rest_framework import pagination
+
+
+class CursorPagination(pagination.CursorPagination):
+    """
+    Cursor pagination whose page size clients can choose with
+    page_size_query_param, up to max_page_size. (DRF's own
+    CursorPagination ignores both and always uses page_size.)
+    page_size_query_aliases are other names the page size is accepted
+    under, e.g. by clients of an older version of a view.
+    """
+    page_size_query_aliases = ()
+
+    def get_page_size(self, request):
+        params = (self.page_size_query_param,) + tuple(self.page_size_query_aliases)
+        for param in params:
+            if param and param in request.query_params:
+                try:
+                    return pagination._positive_int(
+                            request.query_params[param],
+                            strict=True, cutoff=self.max_page_size)
+                except ValueError:
+                    pass
+        return self.page_size
@@ -0,0 +1,42 @@
+from rest_framework.permissions import SAFE_METHODS
+
+
+def get_requested_fields(request):
+    """
+    Return the sets of field names asked for with ?fields= and left out
+    with ?exclude=; the first is None if the client didn't say.
+    """
+    # Writes always deal in whole objects
+    if request is None or request.method not in SAFE_METHODS:
+        return None, set()
+    params = request.query_params
+    fields = params.get('fields')
+    fields = set(_ for _ in fields.split(',') if _) if fields else None
+    exclude = set(_ for _ in params.get('exclude', '').split(',') if _)
+    return fields, exclude
+
+
+def is_field_requested(request, name):
+    """Return True if the field called name would be sent in the response."""
+    fields, exclude = get_requested_fields(request)
+    return (fields is None or name in fields) and name not in exclude
+
+
+class SparseFieldsetMixin(object):
+    """
+    Let clients choose which of a serializer's fields they get, with
+    ?fields=id,name or ?exclude=description. Fields that aren't sent are
+    dropped before serialization, so their sources are never evaluated.
+
+    Only the serializer that a view creates (with the request in its
+    context) is pruned; nested serializers send all of their fields.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsetMixin, self).__init__(*args, **kwargs)
+        # Serializers nested in another are created without a context
+        if 'context' in kwargs:
+            request = self.context.get('request')
+            for name in list(self.fields.keys()):
+                if not is_field_requested(request, name):
+                    self.fields.pop(name)
@@ -170,6 +170,26 @@ CORS_ORIGIN_WHITELIST = (
 
 # Google reverse-geocoding url template string
 GOOGLE_REVERSE_GEOCODING_URL_STRING_TEMPLATE = 'https://maps.googleapis.com/maps/api/geocode/json?latlng=%s,%s'
+# Sites are geocoded after commit on a pool of this many background threads;
+# set GEOCODING_SYNCHRONOUS to geocode inside save() instead
+GEOCODING_WORKERS = 2
+GEOCODING_SYNCHRONOUS = False
+# Seconds to wait for the geocoder before giving up
+GEOCODING_TIMEOUT = 5
+# Geocoding results are shared between positions that agree to this many
+# decimal places (3 places is about 100 m), for GEOCODING_CACHE_TTL seconds;
+# up to GEOCODING_CACHE_SIZE of them are also kept in memory
+GEOCODING_CACHE_PRECISION = 3
+GEOCODING_CACHE_TTL = 60 * 60 * 24 * 90
+GEOCODING_CACHE_SIZE = 10000
+
+# Seconds to keep whole responses to anonymous requests in the cache.
+# They're stored under their ETag, so they never go stale; this just lets
+# old versions expire
+RESPONSE_CACHE_TIMEOUT = 60 * 60
+
+# Minimum distance, in metres, between two sites of the same type
+MINIMUM_SITE_SEPARATION = 100
 
 SITE_ID = 1
 
@@ -213,6 +233,13 @@ ACTSTREAM_SETTINGS = {
         'FETCH_RELATIONS': False
         }
 
+# Number of actions kept in each user's activity feed
+FEED_MAX_LENGTH = 500
+
+# Seconds to keep a user's follow suggestions; they're also dropped
+# whenever anyone follows or unfollows anyone
+SUGGESTIONS_CACHE_TIMEOUT = 60 * 60 * 24
+
 def get_cache():
     try:
         os.environ['MEMCACHE_SERVERS'] = os.environ['MEMCACHIER_SERVERS'].replace(',', ';')
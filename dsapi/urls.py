@@ -58,4 +58,6 @@ urlpatterns = [
     url(r'^auth/google/$', GoogleLogin.as_view(), name='google_login'),
     url(r'^accounts/', include('allauth.socialaccount.urls')),
     url(r'^statistics/$', sitestatistics.views.site_statistics),
+    url(r'^nearby/$', divesites.views.nearby, name='nearby'),
+    url(r'^tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)/$', divesites.views.tile, name='tile'),
 ]
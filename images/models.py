@@ -8,6 +8,7 @@ from django.contrib.auth.models import User
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from divesites.models import Compressor, Divesite, Slipway
+from dsapi import conditional
 
 
 class Image(models.Model):
@@ -82,3 +83,7 @@ def send_image_creation_action(sender, instance, created, **kwargs):
         verb = 'added an image'
         action.send(instance.owner, verb=verb, action_object=instance, target=instance.content_object)
 post_save.connect(send_image_creation_action, sender=Image)
+
+# Keep version stamps for conditional GETs (see dsapi.conditional)
+conditional.track(Image, 'object_id', 'owner')
+conditional.track(UserProfileImage, 'user')
@@ -1,4 +1,5 @@
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
 from django.http import HttpResponseBadRequest
 from django.shortcuts import render
 from rest_framework import mixins, status, viewsets
@@ -8,14 +9,30 @@ from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.response import Response
 from divesites.models import Compressor, Divesite, Slipway
 from divesites.permissions import IsOwnerOrReadOnly
+from dsapi.conditional import PROFILE_TAGS, ConditionalGetMixin
 from .models import Image
 from .serializers import ImageSerializer
 
-class ImageViewSet(viewsets.ModelViewSet):
+class ImageViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     parser_classes = (FormParser, MultiPartParser, JSONParser,)
     permission_classes = (IsAuthenticatedOrReadOnly, IsOwnerOrReadOnly,)
     queryset = Image.objects.all()
     serializer_class = ImageSerializer
+    version_tags = {
+            'list': ('images.image:object_id={site}',) + PROFILE_TAGS,
+            'retrieve': ('images.image:{pk}',) + PROFILE_TAGS,
+            }
+
+    def get_version_tag_kwargs(self):
+        kwargs = super(ImageViewSet, self).get_version_tag_kwargs()
+        # Images are listed under whichever kind of site they're of
+        for name in ('compressor_pk', 'divesite_pk', 'slipway_pk'):
+            if name in kwargs:
+                try:
+                    kwargs['site'] = Image._meta.get_field('object_id').to_python(kwargs[name])
+                except ValidationError:
+                    kwargs['site'] = None
+        return kwargs
 
     def check_ownership(self, obj):
         user = self.request.user
@@ -0,0 +1,141 @@
+"""
+Activity feeds, materialized per user. When an action is created it's
+written to the feed of everyone who follows its actor, target or action
+object (and of the actor), so reading a feed is a range scan of one
+user's entries rather than a query across everyone they follow.
+"""
+from actstream.models import Action, Follow, user_stream
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.db.models import Q
+from dsapi import conditional
+
+
+def get_recipients(action):
+    """Return the ids of the users whose feeds action belongs in."""
+    def following(content_type_id, object_id):
+        return Q(content_type_id=content_type_id, object_id=object_id)
+    query = following(action.actor_content_type_id, action.actor_object_id)
+    # Follows can be of actors only, or of everything an object does or
+    # has done to it
+    for content_type_id, object_id in [
+            (action.target_content_type_id, action.target_object_id),
+            (action.action_object_content_type_id, action.action_object_object_id),
+            ]:
+        if content_type_id is not None:
+            query |= Q(actor_only=False) & following(content_type_id, object_id)
+    recipients = set(Follow.objects.filter(query).values_list('user_id', flat=True))
+    # Users see their own activity too
+    if action.actor_content_type_id == ContentType.objects.get_for_model(User).id:
+        recipients.add(int(action.actor_object_id))
+    return recipients
+
+
+def feeds_changed(user_ids):
+    """Bump the version stamps of these users' feeds (see dsapi.conditional)."""
+    tags = [conditional.relation_tag('profiles.feedentry', 'user', _) for _ in user_ids]
+    if tags:
+        conditional.changed(*tags)
+
+
+def trim_feeds(user_ids):
+    """Drop all but the newest FEED_MAX_LENGTH entries of these users' feeds."""
+    if not user_ids:
+        return
+    FeedEntry = apps.get_model('profiles', 'FeedEntry')
+    table = connection.ops.quote_name(FeedEntry._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+                'DELETE FROM {table} WHERE id IN ('
+                '  SELECT id FROM ('
+                '    SELECT id, row_number() OVER ('
+                '      PARTITION BY user_id ORDER BY timestamp DESC, id DESC) AS position'
+                '    FROM {table} WHERE user_id IN %s'
+                '  ) AS ranked WHERE position > %s'
+                ')'.format(table=table),
+                [tuple(user_ids), settings.FEED_MAX_LENGTH])
+
+
+def add_to_feeds(action):
+    """Write a new action to the feeds it belongs in."""
+    FeedEntry = apps.get_model('profiles', 'FeedEntry')
+    if not action.public:
+        return
+    recipients = get_recipients(action)
+    FeedEntry.objects.bulk_create([
+        FeedEntry(user_id=user_id, action=action, timestamp=action.timestamp)
+        for user_id in recipients
+        ])
+    trim_feeds(recipients)
+    feeds_changed(recipients)
+
+
+def followed_actions(follow):
+    """Return the actions that follow brings into the follower's feed."""
+    content_type_id, object_id = follow.content_type_id, follow.object_id
+    query = Q(actor_content_type_id=content_type_id, actor_object_id=object_id)
+    if not follow.actor_only:
+        query |= Q(target_content_type_id=content_type_id, target_object_id=object_id)
+        query |= Q(action_object_content_type_id=content_type_id, action_object_object_id=object_id)
+    return Action.objects.filter(query, public=True)
+
+
+def backfill_feed(follow):
+    """Add recent activity of something newly followed to the follower's feed."""
+    FeedEntry = apps.get_model('profiles', 'FeedEntry')
+    actions = followed_actions(follow).exclude(feed_entries__user_id=follow.user_id)
+    actions = actions.order_by('-timestamp').values_list('id', 'timestamp')[:settings.FEED_MAX_LENGTH]
+    FeedEntry.objects.bulk_create([
+        FeedEntry(user_id=follow.user_id, action_id=action_id, timestamp=timestamp)
+        for action_id, timestamp in actions
+        ])
+    trim_feeds([follow.user_id])
+    feeds_changed([follow.user_id])
+
+
+def remove_from_feed(follow):
+    """
+    Take activity of something no longer followed out of the follower's
+    feed, unless the follower still has another reason to see it.
+    """
+    FeedEntry = apps.get_model('profiles', 'FeedEntry')
+    # What the follower still follows, and whether only as an actor
+    actor_only = {}
+    follows = Follow.objects.filter(user_id=follow.user_id).values_list('content_type_id', 'object_id', 'actor_only')
+    for content_type_id, object_id, only in follows:
+        key = (content_type_id, object_id)
+        actor_only[key] = actor_only.get(key, True) and only
+    # Users see their own activity too
+    actor_only.setdefault((ContentType.objects.get_for_model(User).id, str(follow.user_id)), True)
+    # The candidates are checked against that by the same rules as
+    # get_recipients, but in memory rather than with a query each
+    actions = followed_actions(follow).filter(feed_entries__user_id=follow.user_id).values_list(
+            'id', 'actor_content_type_id', 'actor_object_id',
+            'target_content_type_id', 'target_object_id',
+            'action_object_content_type_id', 'action_object_object_id')
+    removed = []
+    for action_id, actor_type, actor_id, target_type, target_id, object_type, object_id in actions:
+        if (actor_type, actor_id) in actor_only:
+            continue
+        if any(actor_only.get(_) is False for _ in [(target_type, target_id), (object_type, object_id)]):
+            continue
+        removed.append(action_id)
+    if removed:
+        FeedEntry.objects.filter(user_id=follow.user_id, action_id__in=removed).delete()
+        feeds_changed([follow.user_id])
+
+
+def rebuild_feed(user):
+    """Rebuild a user's feed from scratch."""
+    FeedEntry = apps.get_model('profiles', 'FeedEntry')
+    FeedEntry.objects.filter(user=user).delete()
+    actions = user_stream(user, with_user_activity=True).order_by('-timestamp')
+    actions = actions.values_list('id', 'timestamp')[:settings.FEED_MAX_LENGTH]
+    FeedEntry.objects.bulk_create([
+        FeedEntry(user=user, action_id=action_id, timestamp=timestamp)
+        for action_id, timestamp in actions
+        ])
+    feeds_changed([user.pk])
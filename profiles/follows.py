@@ -0,0 +1,106 @@
+"""
+Who follows whom, cached. Each user's followers and follows are kept in
+the cache as packed arrays of user ids, which are dropped whenever one of
+that user's follows changes and rebuilt, in bulk, the next time they're
+asked for. Lists of profiles are then fetched in one query.
+"""
+from array import array
+from actstream.models import Follow
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import transaction
+
+FOLLOWERS = 'followers'
+FOLLOWING = 'following'
+
+
+def adjacency_key(direction, user_id):
+    return 'follows:%s:%s' % (direction, user_id)
+
+
+def user_follows():
+    """Return Follows of users (as opposed to of other kinds of object)."""
+    return Follow.objects.filter(content_type=ContentType.objects.get_for_model(User))
+
+
+def pack(ids):
+    return array('q', ids).tobytes()
+
+
+def unpack(packed):
+    ids = array('q')
+    ids.frombytes(packed)
+    return list(ids)
+
+
+def load_adjacency(direction, user_ids):
+    """Read the followers or follows of user_ids from the DB."""
+    follows = user_follows().order_by('id')
+    adjacency = dict((user_id, []) for user_id in user_ids)
+    if direction == FOLLOWING:
+        pairs = follows.filter(user_id__in=user_ids).values_list('user_id', 'object_id')
+        for user_id, object_id in pairs:
+            adjacency[user_id].append(int(object_id))
+    else:
+        pairs = follows.filter(object_id__in=[str(_) for _ in user_ids]).values_list('object_id', 'user_id')
+        for object_id, user_id in pairs:
+            adjacency[int(object_id)].append(user_id)
+    return adjacency
+
+
+def get_adjacency(direction, user_ids):
+    """
+    Return a dict of each of user_ids to the ids of its followers (or of
+    the users it follows), from the cache where possible.
+    """
+    user_ids = list(user_ids)
+    keys = dict((adjacency_key(direction, user_id), user_id) for user_id in user_ids)
+    cached = cache.get_many(list(keys.keys()))
+    adjacency = dict((keys[key], unpack(packed)) for key, packed in cached.items())
+    missing = [user_id for user_id in user_ids if user_id not in adjacency]
+    if missing:
+        loaded = load_adjacency(direction, missing)
+        cache.set_many(dict((adjacency_key(direction, user_id), pack(ids)) for user_id, ids in loaded.items()), None)
+        adjacency.update(loaded)
+    return adjacency
+
+
+def get_follower_ids(user_id):
+    return get_adjacency(FOLLOWERS, [user_id])[user_id]
+
+
+def get_following_ids(user_id):
+    return get_adjacency(FOLLOWING, [user_id])[user_id]
+
+
+def get_profiles(user_ids):
+    """
+    Return the profiles of user_ids, in that order, in a single query,
+    each with follower_count and following_count attributes.
+    """
+    Profile = apps.get_model('profiles', 'Profile')
+    user_ids = list(user_ids)
+    profiles = Profile.objects.filter(user_id__in=user_ids).select_related('user__profile_image')
+    profiles = dict((profile.user_id, profile) for profile in profiles)
+    followers = get_adjacency(FOLLOWERS, user_ids)
+    following = get_adjacency(FOLLOWING, user_ids)
+    for user_id, profile in profiles.items():
+        profile.follower_count = len(followers[user_id])
+        profile.following_count = len(following[user_id])
+    return [profiles[user_id] for user_id in user_ids if user_id in profiles]
+
+
+def forget(follow):
+    """Drop the cached adjacency of both ends of follow."""
+    if follow.content_type_id != ContentType.objects.get_for_model(User).id:
+        return
+    keys = [
+            adjacency_key(FOLLOWING, follow.user_id),
+            adjacency_key(FOLLOWERS, int(follow.object_id)),
+            ]
+    cache.delete_many(keys)
+    # ...and again after commit, in case they've been rebuilt from the data
+    # from before this change in the meantime
+    transaction.on_commit(lambda: cache.delete_many(keys))
@@ -0,0 +1,23 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from profiles import feeds
+
+
+class Command(BaseCommand):
+    help = "Rebuild users' activity feeds from their follows and the action log"
+
+    def add_arguments(self, parser):
+        parser.add_argument('users', nargs='*', type=int,
+                help='IDs of the users whose feeds to rebuild (by default, everyone)')
+
+    def handle(self, *args, **options):
+        users = User.objects.order_by('pk')
+        if options['users']:
+            users = users.filter(pk__in=options['users'])
+        rebuilt = 0
+        for user in users.iterator():
+            with transaction.atomic():
+                feeds.rebuild_feed(user)
+            rebuilt += 1
+        self.stdout.write('Rebuilt %d feeds' % rebuilt)
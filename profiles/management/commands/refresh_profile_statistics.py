@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from profiles.models import ProfileStatistics
+
+
+class Command(BaseCommand):
+    help = ("Bring profiles' rolling 90- and 365-day dive counts up to date; "
+            "run this daily")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False,
+                help='Recompute every profile, not just those with recent dives')
+
+    def handle(self, *args, **options):
+        statistics = ProfileStatistics.objects.select_related('profile')
+        if not options['all']:
+            # Dive signals keep everything else current, and the counts only
+            # go down as time passes, so only non-zero counts can be stale
+            statistics = statistics.filter(Q(dives_in_last_365_days__gt=0) | Q(dives_in_last_90_days__gt=0))
+        updated = 0
+        for record in statistics.iterator():
+            record.update()
+            updated += 1
+        self.stdout.write('Updated statistics for %d profiles' % updated)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9 on 2016-10-18 15:00
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def create_profile_statistics(apps, schema_editor):
+    Dive = apps.get_model('divesites', 'Dive')
+    Profile = apps.get_model('profiles', 'Profile')
+    ProfileStatistics = apps.get_model('profiles', 'ProfileStatistics')
+    today = django.utils.timezone.now().date()
+    for profile in Profile.objects.all():
+        dives = Dive.objects.filter(diver_id=profile.user_id)
+        ProfileStatistics.objects.create(
+                profile=profile,
+                dive_count=dives.count(),
+                duration_underwater=dives.aggregate(total=models.Sum('duration'))['total'] or datetime.timedelta(0),
+                divesites_visited=dives.values('divesite').distinct().count(),
+                dives_in_last_365_days=dives.filter(date__gte=today - datetime.timedelta(days=365)).count(),
+                dives_in_last_90_days=dives.filter(date__gte=today - datetime.timedelta(days=90)).count(),
+                )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('divesites', '0027_divesite_dive_totals'),
+        ('profiles', '0002_profile_follow_targets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfileStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dive_count', models.IntegerField(default=0)),
+                ('duration_underwater', models.DurationField(default=datetime.timedelta(0))),
+                ('divesites_visited', models.IntegerField(default=0)),
+                ('dives_in_last_365_days', models.IntegerField(default=0)),
+                ('dives_in_last_90_days', models.IntegerField(default=0)),
+                ('last_updated', models.DateTimeField(default=django.utils.timezone.now)),
+                ('profile', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='profiles.Profile')),
+            ],
+        ),
+        migrations.RunPython(create_profile_statistics, migrations.RunPython.noop),
+    ]
@@ -2,9 +2,13 @@ import uuid
 
 from datetime import timedelta
 from django.db import models
+from django.db.models.signals import post_delete, post_init, post_save
 from django.utils import timezone
 from django.contrib.auth.models import User
+from actstream.models import Action, Follow
 from divesites.models import Dive
+from dsapi import conditional
+from . import feeds, follows
 
 # Create your models here.
 class Profile(models.Model):
@@ -22,19 +26,79 @@ class Profile(models.Model):
     # Users this user follows
     follow_targets = models.ManyToManyField('self', related_name='followers', symmetrical=False)
 
-    # Some stats
+    # Some stats, read from the profile's ProfileStatistics record
+    def get_statistics(self):
+        try:
+            return self.statistics
+        except ProfileStatistics.DoesNotExist:
+            statistics = ProfileStatistics(profile=self)
+            statistics.update()
+            return statistics
     def get_hours_underwater(self):
-        return sum([_.duration.total_seconds() for _ in self.user.dives.all()]) // (3600)
+        return self.get_statistics().duration_underwater.total_seconds() // (3600)
     def get_number_of_divesites_visited(self):
-        return len(set([_.divesite for _ in self.user.dives.all()]))
+        return self.get_statistics().divesites_visited
     def count_dives_in_last_365_days(self):
-        return Dive.objects.filter(diver=self.user, date__gte=timezone.now() - timedelta(days=365)).count()
+        return self.get_statistics().dives_in_last_365_days
     def count_dives_in_last_90_days(self):
-        return Dive.objects.filter(diver=self.user, date__gte=timezone.now() - timedelta(days=90)).count()
+        return self.get_statistics().dives_in_last_90_days
+
+
+class ProfileStatistics(models.Model):
+    """
+    A profile's dive statistics, worked out in advance so that showing a
+    profile doesn't mean going through all of its dives. These are brought
+    up to date whenever the user's dives change; the rolling 90- and
+    365-day counts also need the refresh_profile_statistics command to be
+    run daily.
+    """
+    profile = models.OneToOneField(Profile, related_name='statistics', on_delete=models.CASCADE)
+    dive_count = models.IntegerField(default=0)
+    duration_underwater = models.DurationField(default=timedelta(0))
+    divesites_visited = models.IntegerField(default=0)
+    dives_in_last_365_days = models.IntegerField(default=0)
+    dives_in_last_90_days = models.IntegerField(default=0)
+    last_updated = models.DateTimeField(default=timezone.now)
+
+    def update(self):
+        """Recompute these statistics from the user's dives, in one query."""
+        today = timezone.now().date()
+        def count_since(days):
+            return models.Sum(models.Case(
+                models.When(date__gte=today - timedelta(days=days), then=1),
+                default=0,
+                output_field=models.IntegerField(),
+                ))
+        statistics = Dive.objects.no_cache().filter(diver_id=self.profile.user_id).aggregate(
+                dive_count=models.Count('id'),
+                duration_underwater=models.Sum('duration'),
+                divesites_visited=models.Count('divesite', distinct=True),
+                dives_in_last_365_days=count_since(365),
+                dives_in_last_90_days=count_since(90),
+                )
+        for field, value in statistics.items():
+            # Sums over no dives at all come back as None
+            setattr(self, field, value if value is not None else self._meta.get_field(field).get_default())
+        self.last_updated = timezone.now()
+        self.save()
+
+
+class FeedEntry(models.Model):
+    """
+    An action in a user's activity feed (see profiles.feeds). The action's
+    timestamp is copied here so that a feed can be read, newest first,
+    from the (user, timestamp) index alone.
+    """
+    class Meta:
+        index_together = [('user', 'timestamp')]
+        unique_together = [('user', 'action')]
+
+    user = models.ForeignKey(User, related_name='feed_entries', on_delete=models.CASCADE)
+    action = models.ForeignKey(Action, related_name='feed_entries', on_delete=models.CASCADE)
+    timestamp = models.DateTimeField()
 
 
 # Post-save signal to create a Profile
-from django.db.models.signals import post_save
 def create_profile(sender, **kwargs):
     user = kwargs['instance']
     if kwargs['created']:
@@ -45,4 +109,50 @@ def create_profile(sender, **kwargs):
         if user.first_name and user.last_name:
             profile.name = ' '.join([user.first_name, user.last_name])
         profile.save()
+        ProfileStatistics.objects.create(profile=profile)
 post_save.connect(create_profile, sender=User)
+
+# Keep a profile's statistics up to date as dives are logged, edited, and
+# deleted. A dive that's moved to another diver changes the statistics of
+# both, so remember whose it was when it was loaded.
+def remember_dive_diver(sender, instance, **kwargs):
+    instance._original_diver_id = instance.__dict__.get('diver_id')
+post_init.connect(remember_dive_diver, sender=Dive)
+
+def update_profile_statistics(sender, instance, **kwargs):
+    diver_ids = set([instance._original_diver_id, instance.diver_id]) - set([None])
+    for profile in Profile.objects.filter(user_id__in=diver_ids):
+        profile.get_statistics().update()
+    instance._original_diver_id = instance.diver_id
+post_save.connect(update_profile_statistics, sender=Dive)
+post_delete.connect(update_profile_statistics, sender=Dive)
+
+# Write actions to their followers' feeds as they happen, and bring feeds
+# into line with who's following what
+def add_action_to_feeds(sender, instance, created, **kwargs):
+    if created:
+        feeds.add_to_feeds(instance)
+post_save.connect(add_action_to_feeds, sender=Action)
+
+def backfill_feed_on_follow(sender, instance, created, **kwargs):
+    if created:
+        feeds.backfill_feed(instance)
+post_save.connect(backfill_feed_on_follow, sender=Follow)
+
+def remove_from_feed_on_unfollow(sender, instance, **kwargs):
+    feeds.remove_from_feed(instance)
+post_delete.connect(remove_from_feed_on_unfollow, sender=Follow)
+
+# Drop the cached followers/follows of both ends of a follow when it
+# changes (see profiles.follows)
+def forget_follow_adjacency(sender, instance, **kwargs):
+    follows.forget(instance)
+post_save.connect(forget_follow_adjacency, sender=Follow)
+post_delete.connect(forget_follow_adjacency, sender=Follow)
+
+# Keep version stamps for conditional GETs (see dsapi.conditional)
+conditional.track(Action, 'actor_object_id')
+conditional.track(Follow)
+conditional.track(Profile)
+conditional.track(ProfileStatistics, 'profile')
+conditional.track(User)
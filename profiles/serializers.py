@@ -1,5 +1,9 @@
+from collections import defaultdict
 from actstream.models import Action
+from django.contrib.contenttypes.models import ContentType
 from rest_framework import serializers
+from rest_framework.exceptions import ValidationError
+from dsapi.serializers import SparseFieldsetMixin
 from .models import Profile
 from django.contrib.auth.models import User
 from divesites.models import Compressor, Dive, Divesite, Slipway
@@ -43,7 +47,7 @@ class UnattributedDiveSerializer(serializers.ModelSerializer):
     divesite = UnattributedDivesiteSerializer()
 
 
-class MinimalProfileSerializer(serializers.ModelSerializer):
+class MinimalProfileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     # a Profile serializer that just provides ID and name fields
     class Meta:
         model = Profile
@@ -51,6 +55,15 @@ class MinimalProfileSerializer(serializers.ModelSerializer):
     profile_image = UserProfileImageSerializer(source='user.profile_image', read_only=True)
 
 
+class FollowProfileSerializer(MinimalProfileSerializer):
+    # A MinimalProfileSerializer plus follow counts, for profiles fetched
+    # with profiles.follows.get_profiles
+    class Meta(MinimalProfileSerializer.Meta):
+        fields = MinimalProfileSerializer.Meta.fields + ('follower_count', 'following_count',)
+    follower_count = serializers.ReadOnlyField()
+    following_count = serializers.ReadOnlyField()
+
+
 class UnattributedCompressorCommentSerializer(serializers.ModelSerializer):
     class Meta:
         model = CompressorComment
@@ -70,37 +83,83 @@ class UnattributedSlipwayCommentSerializer(serializers.ModelSerializer):
         fields = ('slipway', 'text', 'creation_date',)
         divesite = UnattributedSlipwaySerializer()
 
-class OwnProfileSerializer(serializers.ModelSerializer):
-    """This serializer exposes an email address and certain other personally-identifying information,
-    so use with care."""
+# Collections of a user's things that a profile can embed with
+# ?include=, keyed on name: the queryset to take them from and the
+# serializer to use. Each is limited to ?<name>_limit= items.
+PROFILE_COLLECTIONS = {
+        'compressors': (lambda user: user.compressors.order_by('-creation_date'),
+            UnattributedCompressorSerializer),
+        'dives': (lambda user: user.dives.select_related('divesite').order_by('-date', '-time'),
+            UnattributedDiveSerializer),
+        'divesites': (lambda user: user.divesites.order_by('-creation_date'),
+            UnattributedDivesiteSerializer),
+        'slipways': (lambda user: user.slipways.order_by('-creation_date'),
+            UnattributedSlipwaySerializer),
+        }
+PROFILE_COLLECTION_DEFAULT_LIMIT = 20
+PROFILE_COLLECTION_MAX_LIMIT = 100
+
+
+def get_included_collections(request):
+    """
+    Return a dict of the collections asked for with ?include= and how many
+    items of each to send.
+    """
+    if request is None or not request.query_params.get('include'):
+        return {}
+    params = request.query_params
+    names = [_ for _ in params['include'].split(',') if _]
+    unknown = set(names) - set(PROFILE_COLLECTIONS.keys())
+    if unknown:
+        raise ValidationError({'include': 'Unknown collections: %s' % ', '.join(sorted(unknown))})
+    included = {}
+    for name in names:
+        try:
+            limit = int(params.get('%s_limit' % name, PROFILE_COLLECTION_DEFAULT_LIMIT))
+        except ValueError:
+            raise ValidationError({'%s_limit' % name: 'Must be an integer.'})
+        if not 0 < limit <= PROFILE_COLLECTION_MAX_LIMIT:
+            raise ValidationError({'%s_limit' % name: 'Must be between 1 and %d.' % PROFILE_COLLECTION_MAX_LIMIT})
+        included[name] = limit
+    return included
+
+
+class BaseProfileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    """
+    A profile's own fields, statistics and counts. The user's dives and
+    sites are only sent if asked for (see PROFILE_COLLECTIONS).
+    """
     class Meta:
         model = Profile
         exclude = ('follow_targets', 'user',)
-    compressors = UnattributedCompressorSerializer(source='user.compressors', many=True, read_only=True)
-    email = serializers.EmailField(source='user.email', read_only=True)
-    dives = UnattributedDiveSerializer(source='user.dives', many=True, read_only=True)
-    divesites = UnattributedDivesiteSerializer(source='user.divesites', many=True, read_only=True)
     date_joined = serializers.ReadOnlyField(source='user.date_joined', read_only=True)
     hours_underwater = serializers.ReadOnlyField(source='get_hours_underwater')
     divesites_visited = serializers.ReadOnlyField(source='get_number_of_divesites_visited');
     dives_in_last_365_days = serializers.ReadOnlyField(source='count_dives_in_last_365_days');
     dives_in_last_90_days = serializers.ReadOnlyField(source='count_dives_in_last_90_days');
-    slipways = UnattributedSlipwaySerializer(source='user.slipways', many=True, read_only=True)
+    dive_count = serializers.ReadOnlyField(source='get_statistics.dive_count')
+    divesite_count = serializers.ReadOnlyField(source='user.divesites.count')
+    compressor_count = serializers.ReadOnlyField(source='user.compressors.count')
+    slipway_count = serializers.ReadOnlyField(source='user.slipways.count')
     profile_image = UserProfileImageSerializer(source='user.profile_image', read_only=True)
 
-class ProfileSerializer(serializers.ModelSerializer):
-    class Meta:
-        model = Profile
-        exclude = ('follow_targets', 'user',)
-    compressors = UnattributedCompressorSerializer(source='user.compressors', many=True, read_only=True)
-    dives = UnattributedDiveSerializer(source='user.dives', many=True, read_only=True)
-    dives_in_last_365_days = serializers.ReadOnlyField(source='count_dives_in_last_365_days');
-    dives_in_last_90_days = serializers.ReadOnlyField(source='count_dives_in_last_90_days');
-    divesites = UnattributedDivesiteSerializer(source='user.divesites', many=True, read_only=True)
-    divesites_visited = serializers.ReadOnlyField(source='get_number_of_divesites_visited');
-    date_joined = serializers.ReadOnlyField(source='user.date_joined', read_only=True)
-    hours_underwater = serializers.ReadOnlyField(source='get_hours_underwater')
-    profile_image = UserProfileImageSerializer(source='user.profile_image', read_only=True)
+    def to_representation(self, instance):
+        data = super(BaseProfileSerializer, self).to_representation(instance)
+        included = get_included_collections(self.context.get('request'))
+        for name, limit in included.items():
+            get_queryset, serializer_class = PROFILE_COLLECTIONS[name]
+            data[name] = serializer_class(get_queryset(instance.user)[:limit], many=True).data
+        return data
+
+
+class OwnProfileSerializer(BaseProfileSerializer):
+    """This serializer exposes an email address and certain other personally-identifying information,
+    so use with care."""
+    email = serializers.EmailField(source='user.email', read_only=True)
+
+
+class ProfileSerializer(BaseProfileSerializer):
+    pass
 
 
 # Generic related field for django-activity-stream objects.
@@ -132,6 +191,54 @@ class GenericRelatedField(serializers.Field):
         return str(value)
 
 
+# Related objects that GenericRelatedField serializes along with each kind
+# of object an action can refer to
+ACTION_OBJECT_SELECT_RELATED = {
+        Dive: ('divesite',),
+        Profile: ('user__profile_image',),
+        User: ('profile', 'profile_image',),
+        }
+ACTION_OBJECT_FIELDS = ('actor', 'target', 'action_object',)
+
+
+def prefetch_action_objects(actions):
+    """
+    Fetch the actors, targets and action objects of a list of actions with
+    one query per content type, rather than one per action and field.
+    """
+    wanted = defaultdict(set)
+    for action in actions:
+        for field in ACTION_OBJECT_FIELDS:
+            content_type_id = getattr(action, '%s_content_type_id' % field)
+            if content_type_id is not None:
+                wanted[content_type_id].add(getattr(action, '%s_object_id' % field))
+    found = {}
+    for content_type_id, object_ids in wanted.items():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        queryset = model._default_manager.filter(pk__in=object_ids)
+        queryset = queryset.select_related(*ACTION_OBJECT_SELECT_RELATED.get(model, ()))
+        for obj in queryset:
+            found[(content_type_id, str(obj.pk))] = obj
+    for action in actions:
+        for field in ACTION_OBJECT_FIELDS:
+            content_type_id = getattr(action, '%s_content_type_id' % field)
+            if content_type_id is None:
+                continue
+            # ContentType.objects caches content types, so this is free
+            setattr(action, '%s_content_type' % field, ContentType.objects.get_for_id(content_type_id))
+            # Fill in the generic foreign key's cache (which holds None for
+            # objects that have since been deleted)
+            obj = found.get((content_type_id, getattr(action, '%s_object_id' % field)))
+            setattr(action, getattr(Action, field).cache_attr, obj)
+    return actions
+
+
+class ActionListSerializer(serializers.ListSerializer):
+    def to_representation(self, data):
+        actions = prefetch_action_objects(list(data.all() if hasattr(data, 'all') else data))
+        return super(ActionListSerializer, self).to_representation(actions)
+
+
 class ActionSerializer(serializers.ModelSerializer):
     # Serialize an activity-stream action. Based on:
     # http://davidmburke.com/2015/07/08/building-an-api-for-django-activity-stream-with-generic-foreign-keys/
@@ -139,6 +246,7 @@ class ActionSerializer(serializers.ModelSerializer):
         model = Action
         fields = ('actor', 'target', 'action_object', 'timestamp', 'verb',
                 'target_type', 'target_object_id',)
+        list_serializer_class = ActionListSerializer
     actor = GenericRelatedField(read_only=True)
     target = GenericRelatedField(read_only=True)
     action_object = GenericRelatedField(read_only=True)
@@ -0,0 +1,47 @@
+"""
+Suggestions of users to follow: people who follow the user, and the
+follows and followers of the people the user follows, ranked by how many
+of the user's follows they're connected to.
+"""
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from dsapi.conditional import get_versions
+from .follows import FOLLOWERS, FOLLOWING, get_adjacency
+
+# Number of suggestions sent to a client
+MAX_SUGGESTIONS = 50
+
+
+def compute_suggestions(user_id):
+    """
+    Return the ids of the users to suggest to user_id, best first, from
+    the cached follow graph (see profiles.follows).
+    """
+    following = set(get_adjacency(FOLLOWING, [user_id])[user_id])
+    followers = set(get_adjacency(FOLLOWERS, [user_id])[user_id])
+    # Everyone connected, either way, to someone the user follows; count
+    # how many of the user's follows each is connected to (once per
+    # follow, even if they're connected both ways)
+    follows_of_follows = get_adjacency(FOLLOWING, following)
+    followers_of_follows = get_adjacency(FOLLOWERS, following)
+    mutual = Counter()
+    for friend in following:
+        mutual.update(set(follows_of_follows[friend]) | set(followers_of_follows[friend]))
+    candidates = (set(mutual) | followers) - following - set([user_id])
+    # Most mutual connections first; then people who follow the user
+    return sorted(candidates, key=lambda _: (-mutual[_], _ not in followers, _))
+
+
+def get_suggestions(user_id):
+    """
+    Return compute_suggestions(user_id), cached until somebody follows or
+    unfollows somebody (since any follow can change anyone's suggestions).
+    """
+    version, = get_versions(['actstream.follow'])
+    key = 'suggestions:%s:%r' % (user_id, version)
+    suggestions = cache.get(key)
+    if suggestions is None:
+        suggestions = compute_suggestions(user_id)
+        cache.set(key, suggestions, settings.SUGGESTIONS_CACHE_TIMEOUT)
+    return suggestions
@@ -1,8 +1,13 @@
 from actstream.actions import follow, unfollow
 from actstream.models import Action, following, followers, user_stream
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
 from faker import Factory
-from divesites.factories import CompressorFactory, DivesiteFactory, SlipwayFactory, UserFactory
+from divesites.factories import CompressorFactory, DiveFactory, DivesiteFactory, SlipwayFactory, UserFactory
+from profiles.models import FeedEntry
 from rest_framework import status
 from rest_framework.test import APITestCase
 
@@ -108,7 +113,7 @@ class ProfileFeedTestCase(APITestCase):
         response = self.client.get(reverse('profile-my-feed'))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         data = response.data
-        self.assertEqual(data['count'], 1)
+        self.assertEqual(len(data['results']), 1)
 
     def test_can_retrieve_divesitecomment_activity(self):
         self.client.force_authenticate(self.u)
@@ -119,7 +124,7 @@ class ProfileFeedTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         response = self.client.get(reverse('profile-my-feed'))
         data = response.data
-        self.assertEqual(data['count'], 1)
+        self.assertEqual(len(data['results']), 1)
 
     def test_can_retrieve_slipwaycomment_activity(self):
         slipway = SlipwayFactory()
@@ -131,7 +136,7 @@ class ProfileFeedTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         response = self.client.get(reverse('profile-my-feed'))
         data = response.data
-        self.assertEqual(data['count'], 1)
+        self.assertEqual(len(data['results']), 1)
 
     def test_can_retrieve_compressorcomment_activity(self):
         compressor = CompressorFactory()
@@ -143,7 +148,7 @@ class ProfileFeedTestCase(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         response = self.client.get(reverse('profile-my-feed'))
         data = response.data
-        self.assertEqual(data['count'], 1)
+        self.assertEqual(len(data['results']), 1)
 
     def test_can_retrieve_activity_for_mixed_types(self):
         slipway = SlipwayFactory()
@@ -186,4 +191,200 @@ class ProfileFeedTestCase(APITestCase):
         response = self.client.get(reverse('profile-my-feed'))
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         data = response.data
-        self.assertEqual(data['count'], 4)
+        self.assertEqual(len(data['results']), 4)
+
+
+class FeedEntryTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.followed = UserFactory()
+
+    def feed(self, user):
+        return list(FeedEntry.objects.filter(user=user).order_by('-timestamp').values_list('action__actor_object_id', flat=True))
+
+    def test_actions_are_written_to_followers_feeds(self):
+        follow(self.user, self.followed, send_action=False)
+        DivesiteFactory(owner=self.followed)
+        self.assertEqual(self.feed(self.user), [str(self.followed.id)])
+        self.assertEqual(self.feed(self.followed), [str(self.followed.id)])
+
+    def test_following_backfills_the_feed(self):
+        DivesiteFactory(owner=self.followed)
+        follow(self.user, self.followed, send_action=False)
+        self.assertEqual(self.feed(self.user), [str(self.followed.id)])
+
+    def test_unfollowing_empties_the_feed(self):
+        follow(self.user, self.followed, send_action=False)
+        DivesiteFactory(owner=self.followed)
+        DivesiteFactory(owner=self.user)
+        unfollow(self.user, self.followed, send_action=False)
+        self.assertEqual(self.feed(self.user), [str(self.user.id)])
+
+    def test_unfollowing_keeps_what_is_still_followed(self):
+        other = UserFactory()
+        follow(self.user, self.followed, send_action=False)
+        follow(self.user, other, send_action=False)
+        DivesiteFactory(owner=other)
+        DivesiteFactory(owner=self.followed)
+        unfollow(self.user, self.followed, send_action=False)
+        self.assertEqual(self.feed(self.user), [str(other.id)])
+
+    def test_unfollowing_queries_dont_grow_with_the_feed(self):
+        def count_unfollow_queries():
+            follow(self.user, self.followed, send_action=False)
+            with CaptureQueriesContext(connection) as queries:
+                unfollow(self.user, self.followed, send_action=False)
+            return len(queries)
+        DivesiteFactory(owner=self.followed)
+        few = count_unfollow_queries()
+        for _ in range(3):
+            DivesiteFactory(owner=self.followed)
+        self.assertEqual(count_unfollow_queries(), few)
+
+    def test_feeds_are_capped(self):
+        with self.settings(FEED_MAX_LENGTH=2):
+            for _ in range(3):
+                DivesiteFactory(owner=self.user)
+        self.assertEqual(len(self.feed(self.user)), 2)
+
+    def test_rebuilding_matches_the_action_stream(self):
+        follow(self.user, self.followed, send_action=False)
+        DivesiteFactory(owner=self.followed)
+        FeedEntry.objects.all().delete()
+        call_command('rebuild_feeds', stdout=StringIO())
+        self.assertEqual(len(self.feed(self.user)), len(user_stream(self.user, with_user_activity=True)))
+
+
+class FeedQueryCountTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(self.user)
+
+    def log_activity(self):
+        divesite = DivesiteFactory(owner=self.user)
+        DiveFactory(diver=self.user, divesite=divesite)
+        CompressorFactory(owner=self.user)
+
+    def count_feed_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('profile-my-feed'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_feed_queries_dont_grow_with_the_page(self):
+        self.log_activity()
+        few = self.count_feed_queries()
+        for _ in range(3):
+            self.log_activity()
+        self.assertEqual(self.count_feed_queries(), few)
+
+
+class FeedPaginationTestCase(APITestCase):
+
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(self.user)
+        for _ in range(5):
+            DivesiteFactory(owner=self.user)
+
+    def test_feeds_are_paginated_with_cursors(self):
+        response = self.client.get(reverse('profile-my-feed'), {'page_size': 2})
+        self.assertNotIn('count', response.data)
+        results = response.data['results']
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            results += response.data['results']
+        self.assertEqual(len(results), 5)
+        timestamps = [_['timestamp'] for _ in results]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+    def test_profile_feed_is_paginated_with_cursors(self):
+        response = self.client.get(reverse('profile-feed', args=[self.user.profile.id]), {'page_size': 3})
+        self.assertEqual(len(response.data['results']), 3)
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
+
+    def test_limit_still_sets_the_page_size(self):
+        response = self.client.get(reverse('profile-my-feed'), {'limit': 4})
+        self.assertEqual(len(response.data['results']), 4)
+        self.assertIsNotNone(response.data['next'])
+
+
+class SuggestionRankingTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(self.user)
+
+    def suggested_ids(self):
+        response = self.client.get(reverse('profile-my-suggestions'))
+        return [_['id'] for _ in response.data]
+
+    def test_suggestions_are_ranked_by_mutual_connections(self):
+        friends = [UserFactory() for _ in range(2)]
+        popular, obscure = UserFactory(), UserFactory()
+        for friend in friends:
+            follow(self.user, friend, send_action=False)
+            follow(friend, popular, send_action=False)
+        follow(friends[0], obscure, send_action=False)
+        self.assertEqual(self.suggested_ids(), [str(popular.profile.id), str(obscure.profile.id)])
+
+    def test_connections_both_ways_count_once(self):
+        friends = [UserFactory() for _ in range(2)]
+        # Created first, so it would win a tie
+        mutual, popular = UserFactory(), UserFactory()
+        for friend in friends:
+            follow(self.user, friend, send_action=False)
+            follow(friend, popular, send_action=False)
+        follow(friends[0], mutual, send_action=False)
+        follow(mutual, friends[0], send_action=False)
+        self.assertEqual(self.suggested_ids(), [str(popular.profile.id), str(mutual.profile.id)])
+
+    def test_suggestions_follow_new_follows(self):
+        friend, candidate = UserFactory(), UserFactory()
+        follow(self.user, friend, send_action=False)
+        follow(friend, candidate, send_action=False)
+        self.assertEqual(self.suggested_ids(), [str(candidate.profile.id)])
+        follow(self.user, candidate, send_action=False)
+        self.assertEqual(self.suggested_ids(), [])
+
+
+class FollowListTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.client.force_authenticate(self.user)
+
+    def add_followers(self, n):
+        for _ in range(n):
+            follow(UserFactory(), self.user, send_action=False)
+
+    def test_follow_lists_carry_counts(self):
+        self.add_followers(2)
+        follow(self.user, UserFactory(), send_action=False)
+        response = self.client.get(reverse('profile-followers', args=[self.user.profile.id]))
+        self.assertEqual(len(response.data), 2)
+        self.assertEqual(response.data[0]['following_count'], 1)
+        self.assertEqual(response.data[0]['follower_count'], 0)
+        response = self.client.get(reverse('profile-my-follows'))
+        self.assertEqual(response.data[0]['follower_count'], 1)
+
+    def test_unfollowing_updates_the_lists(self):
+        followed = UserFactory()
+        follow(self.user, followed, send_action=False)
+        self.assertEqual(len(self.client.get(reverse('profile-my-follows')).data), 1)
+        unfollow(self.user, followed, send_action=False)
+        self.assertEqual(self.client.get(reverse('profile-my-follows')).data, [])
+
+    def test_follower_list_queries_dont_grow_with_followers(self):
+        url = reverse('profile-my-followers')
+        self.add_followers(1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        few = len(queries)
+        self.add_followers(4)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(queries), few)
@@ -1,15 +1,20 @@
 import os
+from datetime import timedelta
+from io import StringIO
 from unittest.mock import patch
 
 from django.core.files import File
+from django.core.management import call_command
 from django.core.urlresolvers import reverse, NoReverseMatch
 from django.contrib.auth.models import User
+from django.utils import timezone
 from faker import Factory as FakeFactory
 from rest_framework import status
 from rest_framework.test import APITestCase
 
 from dsapi import settings
 from divesites.factories import DivesiteFactory, DiveFactory, UserFactory
+from divesites.models import Dive
 from images.models import UserProfileImage
 from profiles.models import Profile
 
@@ -200,3 +205,74 @@ class ProfileImageTestCase(APITestCase):
         self.client.force_authenticate(self.user)
         response = self.client.delete(reverse('profile-profile-image', args=[self.user.profile.id]))
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+class ProfileStatisticsTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        self.divesite = DivesiteFactory()
+        today = timezone.now().date()
+        self.dives = [
+                DiveFactory(diver=self.user, divesite=self.divesite, date=today, duration=timedelta(minutes=90)),
+                DiveFactory(diver=self.user, divesite=self.divesite, date=today - timedelta(days=100), duration=timedelta(minutes=30)),
+                DiveFactory(diver=self.user, date=today - timedelta(days=400), duration=timedelta(minutes=60)),
+                ]
+
+    def test_statistics_are_returned(self):
+        response = self.client.get(reverse('profile-detail', args=[self.user.profile.id]))
+        data = response.data
+        self.assertEqual(data['hours_underwater'], 3)
+        self.assertEqual(data['divesites_visited'], 2)
+        self.assertEqual(data['dives_in_last_365_days'], 2)
+        self.assertEqual(data['dives_in_last_90_days'], 1)
+
+    def test_statistics_follow_deleted_dives(self):
+        self.dives[0].delete()
+        profile = Profile.objects.get(id=self.user.profile.id)
+        self.assertEqual(profile.get_hours_underwater(), 1)
+        self.assertEqual(profile.count_dives_in_last_90_days(), 0)
+
+    def test_statistics_follow_dives_to_another_diver(self):
+        other = UserFactory()
+        dive = Dive.objects.get(id=self.dives[0].id)
+        dive.diver = other
+        dive.save()
+        self.assertEqual(Profile.objects.get(id=self.user.profile.id).count_dives_in_last_90_days(), 0)
+        self.assertEqual(Profile.objects.get(id=other.profile.id).count_dives_in_last_90_days(), 1)
+
+    def test_refresh_updates_rolling_windows(self):
+        self.dives[0].date = timezone.now().date() - timedelta(days=200)
+        Dive.objects.filter(id=self.dives[0].id).update(date=self.dives[0].date)
+        call_command('refresh_profile_statistics', stdout=StringIO())
+        profile = Profile.objects.get(id=self.user.profile.id)
+        self.assertEqual(profile.count_dives_in_last_90_days(), 0)
+        self.assertEqual(profile.count_dives_in_last_365_days(), 2)
+
+
+class ProfileCollectionsTestCase(APITestCase):
+    def setUp(self):
+        self.user = UserFactory()
+        for _ in range(3):
+            DiveFactory(diver=self.user)
+        DivesiteFactory(owner=self.user)
+        self.url = reverse('profile-detail', args=[self.user.profile.id])
+
+    def test_collections_are_left_out_by_default(self):
+        response = self.client.get(self.url)
+        for name in ['compressors', 'dives', 'divesites', 'slipways']:
+            self.assertNotIn(name, response.data)
+        self.assertEqual(response.data['dive_count'], 3)
+        self.assertEqual(response.data['divesite_count'], 1)
+        self.assertEqual(response.data['slipway_count'], 0)
+
+    def test_collections_can_be_included_and_limited(self):
+        response = self.client.get(self.url, {'include': 'dives,divesites', 'dives_limit': 2})
+        self.assertEqual(len(response.data['dives']), 2)
+        self.assertEqual(len(response.data['divesites']), 1)
+        self.assertNotIn('slipways', response.data)
+
+    def test_unknown_collections_are_rejected(self):
+        response = self.client.get(self.url, {'include': 'wrecks'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.url, {'include': 'dives', 'dives_limit': 0})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -1,10 +1,10 @@
 from actstream.actions import follow, unfollow
-from actstream.models import Action, Follow, followers, following, user_stream
+from actstream.models import Action
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.shortcuts import render, get_object_or_404
 from rest_framework import exceptions
 from rest_framework import mixins
-from rest_framework import pagination
 from rest_framework import permissions
 from rest_framework import status
 from rest_framework import viewsets
@@ -12,26 +12,84 @@ from rest_framework.decorators import api_view, detail_route, list_route, permis
 from rest_framework.exceptions import NotAuthenticated, PermissionDenied
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly
-from .models import Profile
+from .models import FeedEntry, Profile
+from . import suggestions
+from .follows import get_follower_ids, get_following_ids, get_profiles
 from .permissions import IsProfileOwnerOrReadOnly
-from .serializers import MinimalProfileSerializer, OwnProfileSerializer, ProfileSerializer, ActionSerializer
+from .serializers import FollowProfileSerializer, MinimalProfileSerializer, OwnProfileSerializer, ProfileSerializer, ActionSerializer
 from divesites.models import Dive, Divesite
+from dsapi.conditional import PROFILE_TAGS, ConditionalGetMixin
+from dsapi.pagination import CursorPagination
 from divesites.serializers import DiveSerializer, DiveListSerializer, DivesiteSerializer
 from images.models import Image, UserProfileImage
 from images.serializers import ImageSerializer, UserProfileImageSerializer
 
 
-class FeedPaginator(pagination.LimitOffsetPagination):
-    default_limit = 10
+class FeedPaginator(CursorPagination):
+    # Keyset pagination on the action timestamp, with opaque next/previous
+    # cursors and no total count, so page n costs the same as page 1
+    ordering = ('-timestamp', '-id',)
+    page_size = 10
+    page_size_query_param = 'page_size'
+    # Feeds were sized with ?limit= before they had cursors
+    page_size_query_aliases = ('limit',)
+    max_page_size = 100
 
 
-class ProfileViewSet(viewsets.GenericViewSet,
+# A profile's own name and image ({pk} is the profile's, {user} its user's;
+# see ProfileViewSet.get_version_tag_kwargs)
+OWN_PROFILE_TAGS = ('auth.user:{user}', 'profiles.profile:{pk}', 'images.userprofileimage:user={user}',)
+# Profiles have statistics and counts of the user's sites, and can include
+# the user's dives (and where they were) and sites (see
+# profiles.serializers.PROFILE_COLLECTIONS)
+PROFILE_DETAIL_TAGS = (
+        'profiles.profilestatistics:profile={pk}',
+        'divesites.compressor:owner={user}', 'divesites.divesite:owner={user}', 'divesites.slipway:owner={user}',
+        'divesites.dive:diver={user}', 'divesites.divesite',
+        ) + OWN_PROFILE_TAGS
+# Feeds show actions, and whatever the actions are about as it is now
+FEED_OBJECT_TAGS = (
+        'actstream.follow',
+        'comments.compressorcomment', 'comments.divesitecomment', 'comments.slipwaycomment',
+        'divesites.compressor', 'divesites.dive', 'divesites.divesite', 'divesites.slipway',
+        'images.image',
+        ) + PROFILE_TAGS
+FOLLOW_TAGS = ('actstream.follow',) + PROFILE_TAGS
+
+
+class ProfileViewSet(ConditionalGetMixin, viewsets.GenericViewSet,
         mixins.UpdateModelMixin,
         mixins.RetrieveModelMixin):
 
     permission_classes = (IsAuthenticatedOrReadOnly, IsProfileOwnerOrReadOnly)
-    queryset = Profile.objects.all()
+    queryset = Profile.objects.select_related('statistics')
     serializer_class = ProfileSerializer
+    version_tags = {
+            'retrieve': PROFILE_DETAIL_TAGS,
+            'me': PROFILE_DETAIL_TAGS,
+            'dives': ('divesites.dive:diver={user}', 'divesites.divesite',) + OWN_PROFILE_TAGS,
+            # Sites list all of their dives, whoever logged them
+            'divesites': ('divesites.divesite:owner={user}', 'divesites.dive',) + PROFILE_TAGS,
+            'images': ('images.image:owner={user}',) + OWN_PROFILE_TAGS,
+            'minimal': OWN_PROFILE_TAGS,
+            'profile_image': ('profiles.profile:{pk}', 'images.userprofileimage:user={user}',),
+            'feed': ('actstream.action:actor_object_id={user}',) + FEED_OBJECT_TAGS,
+            'my_feed': ('profiles.feedentry:user={user}',) + FEED_OBJECT_TAGS,
+            'followers': FOLLOW_TAGS,
+            'follows': FOLLOW_TAGS,
+            'my_followers': FOLLOW_TAGS,
+            'my_follows': FOLLOW_TAGS,
+            'my_suggestions': FOLLOW_TAGS,
+            }
+
+    def get_version_tag_kwargs(self):
+        kwargs = super(ProfileViewSet, self).get_version_tag_kwargs()
+        # Most of what a profile shows belongs to its user
+        if 'pk' in kwargs:
+            kwargs['user'] = Profile.objects.filter(pk=kwargs['pk']).values_list('user_id', flat=True).first()
+        else:
+            kwargs['pk'], kwargs['user'] = self.request.user.profile.pk, self.request.user.pk
+        return kwargs
 
     @detail_route(methods=['post'], permission_classes=[IsAuthenticated])
     def follow(self, request, pk):
@@ -51,20 +109,16 @@ class ProfileViewSet(viewsets.GenericViewSet,
     def followers(self, request, pk):
         queryset = Profile.objects.all()
         profile = get_object_or_404(queryset, pk=pk)
-        user = profile.user
-        targets = followers(user)
-        profiles = [_.profile for _ in targets]
-        serializer = MinimalProfileSerializer(profiles, many=True)
+        profiles = get_profiles(get_follower_ids(profile.user_id))
+        serializer = FollowProfileSerializer(profiles, many=True)
         return Response(serializer.data)
 
     @detail_route(methods=['get'])
     def follows(self, request, pk):
         queryset = Profile.objects.all()
         profile = get_object_or_404(queryset, pk=pk)
-        user = profile.user
-        targets = following(user)
-        profiles = [_.profile for _ in targets]
-        serializer = MinimalProfileSerializer(profiles, many=True)
+        profiles = get_profiles(get_following_ids(profile.user_id))
+        serializer = FollowProfileSerializer(profiles, many=True)
         return Response(serializer.data)
 
     @detail_route(methods=['post'], permission_classes=[IsAuthenticated])
@@ -83,60 +137,44 @@ class ProfileViewSet(viewsets.GenericViewSet,
     @list_route(methods=['get'], permission_classes=[IsAuthenticated])
     def me(self, request):
         """Return the requesting user's own profile."""
-        serializer = OwnProfileSerializer(request.user.profile)
+        serializer = OwnProfileSerializer(request.user.profile, context={'request': request})
         return Response(serializer.data)
 
     @list_route(methods=['get'], permission_classes=[IsAuthenticated])
     def my_feed(self, request):
         """
         Retrieve the list of actions for which the requesting user is
-        (a) the actor
+        (a) the actor, or (b) following the actor, target or action object
         """
         user = request.user
-        qs = user_stream(user, with_user_activity=True)
+        # Read the user's materialized feed (see profiles.feeds)
+        qs = FeedEntry.objects.filter(user=user).select_related('action')
         # Paginate the queryset
         paginator = FeedPaginator()
         paginated_queryset = paginator.paginate_queryset(qs, request, view=self)
-        serializer = ActionSerializer(paginated_queryset, many=True)
+        serializer = ActionSerializer([_.action for _ in paginated_queryset], many=True)
         # Generate a response
         paginated_response = paginator.get_paginated_response(serializer.data)
         return paginated_response
 
     @list_route(methods=['get'], permission_classes=[IsAuthenticated])
     def my_followers(self, request):
-        user = request.user
-        targets = followers(user)
-        target_profiles = [_.profile for _ in targets]
-        serializer = MinimalProfileSerializer(target_profiles, many=True)
+        target_profiles = get_profiles(get_follower_ids(request.user.id))
+        serializer = FollowProfileSerializer(target_profiles, many=True)
         return Response(serializer.data)
 
     @list_route(methods=['get'], permission_classes=[IsAuthenticated])
     def my_follows(self, request):
-        user = request.user
-        targets = following(user, User)
-        target_profiles = [_.profile for _ in targets]
-        serializer = MinimalProfileSerializer(target_profiles, many=True)
+        target_profiles = get_profiles(get_following_ids(request.user.id))
+        serializer = FollowProfileSerializer(target_profiles, many=True)
         return Response(serializer.data)
 
     @list_route(methods=['get'], permission_classes=[IsAuthenticated])
     def my_suggestions(self, request):
-        # Big method. We'll start with followers, then have follows of follows
-        user = request.user
-        users_following_me = [u for u in followers(user) if not Follow.objects.is_following(user, u)]
-        followers_of_follows = []
-        follows_of_follows = []
-        # Now look at the users that we're following
-        for user_i_follow in following(user):
-            for follow_of_follow in following(user_i_follow):
-                if follow_of_follow.id != user.id and not Follow.objects.is_following(user, follow_of_follow):
-                    follows_of_follows += [follow_of_follow]
-            for follower_of_follow in followers(user_i_follow):
-                if follower_of_follow.id != user.id and not Follow.objects.is_following(user, follower_of_follow):
-                    followers_of_follows += [follower_of_follow]
-
-        target_profiles = set([_.profile for _ in users_following_me + follows_of_follows + followers_of_follows])
-        print(target_profiles)
-        serializer = MinimalProfileSerializer(target_profiles, many=True)
+        # Suggest followers, and follows and followers of follows, most
+        # mutual connections first (see profiles.suggestions)
+        user_ids = suggestions.get_suggestions(request.user.id)[:suggestions.MAX_SUGGESTIONS]
+        serializer = FollowProfileSerializer(get_profiles(user_ids), many=True)
         return Response(serializer.data)
 
     @detail_route(methods=['get'])
@@ -159,7 +197,9 @@ class ProfileViewSet(viewsets.GenericViewSet,
     def feed(self, request, pk):
         queryset = Profile.objects.all()
         profile = get_object_or_404(queryset, pk=pk)
-        qs = Action.objects.filter(actor_object_id=profile.user.id)
+        qs = Action.objects.filter(
+                actor_content_type=ContentType.objects.get_for_model(User),
+                actor_object_id=profile.user.id)
         # Paginate the queryset
         paginator = FeedPaginator()
         paginated_queryset = paginator.paginate_queryset(qs, request, view=self)
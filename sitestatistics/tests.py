@@ -1,3 +1,38 @@
-from django.test import TestCase
+import json
+from datetime import timedelta
+from django.core.cache import cache
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from divesites import factories
+
+
+class SiteStatisticsTestCase(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_statistics_count_everything(self):
+        factories.CompressorFactory()
+        factories.DiveFactory(duration=timedelta(minutes=90))
+        factories.DiveFactory(duration=timedelta(minutes=45))
+        response = self.client.get('/statistics/')
+        self.assertEqual(response.data['compressors'], 1)
+        self.assertEqual(response.data['dives'], 2)
+        self.assertEqual(response.data['divesites'], 2)
+        self.assertEqual(response.data['slipways'], 0)
+        self.assertEqual(response.data['total_hours_underwater'], 2)
+
+    def test_statistics_are_cached_until_something_changes(self):
+        self.client.get('/statistics/')
+        with self.assertNumQueries(0):
+            self.client.get('/statistics/')
+        factories.DivesiteFactory()
+        response = self.client.get('/statistics/')
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['divesites'], 1)
+
+    def test_statistics_are_cached_for_authenticated_users_too(self):
+        self.client.force_authenticate(factories.UserFactory())
+        self.client.get('/statistics/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/statistics/')
+        self.assertEqual(response.data['users'], 1)
@@ -1,34 +1,63 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 
 from divesites.models import Compressor, Dive, Divesite, Slipway
+from dsapi.conditional import conditional, get_versions
 from images.models import Image
 from profiles.models import Profile
 
-# Create your views here.
+def get_site_statistics():
+    """
+    Count everything in a single round trip to the DB. This goes straight
+    to the database rather than through Cache Machine, which can't cache
+    aggregates (or values_list; see
+    https://github.com/django-cache-machine/django-cache-machine/issues/116)
+    """
+    counted = (
+            ('compressors', Compressor),
+            ('dives', Dive),
+            ('divesites', Divesite),
+            ('images', Image),
+            ('slipways', Slipway),
+            ('users', Profile),
+            )
+    counts = ', '.join('(SELECT COUNT(*) FROM %s)' % connection.ops.quote_name(model._meta.db_table)
+            for _, model in counted)
+    duration = 'SELECT COALESCE(EXTRACT(EPOCH FROM SUM(duration)), 0) FROM %s' % (
+            connection.ops.quote_name(Dive._meta.db_table))
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT %s, (%s)' % (counts, duration))
+        row = cursor.fetchone()
+    statistics = dict(zip([name for name, _ in counted], row))
+    statistics['total_hours_underwater'] = int(row[-1] // 3600)
+    return statistics
+
+
+# The models that get_site_statistics counts
+STATISTICS_TAGS = ('divesites.compressor', 'divesites.dive', 'divesites.divesite', 'divesites.slipway',
+        'images.image', 'profiles.profile',)
+
+
+def get_cached_site_statistics():
+    """
+    Return get_site_statistics(), cached until something it counts changes.
+    The counts are the same for everybody, so unlike the response cache
+    this serves authenticated users too.
+    """
+    key = 'sitestatistics:%s' % ','.join('%r' % _ for _ in get_versions(STATISTICS_TAGS))
+    statistics = cache.get(key)
+    if statistics is None:
+        statistics = get_site_statistics()
+        cache.set(key, statistics, settings.RESPONSE_CACHE_TIMEOUT)
+    return statistics
+
+
 @api_view(['GET'])
 @renderer_classes((JSONRenderer,))
+@conditional(*STATISTICS_TAGS)
 def site_statistics(request):
-    compressors = Compressor.objects.count()
-    dives = Dive.objects.count()
-    divesites = Divesite.objects.count()
-    images = Image.objects.count()
-    slipways = Slipway.objects.count()
-    # Cache Machine doesn't play well with values_list
-    # (see https://github.com/django-cache-machine/django-cache-machine/issues/116)
-    # so we'll just ask for the full set of Dive objects and then iterate over them
-    # rather than getting nothing but their duration
-    total_hours_underwater = int(sum([dive.duration.seconds for dive in Dive.objects.all()]) / 3600)
-    users = Profile.objects.count()
-    obj = {
-            'compressors': compressors,
-            'dives': dives,
-            'divesites': divesites,
-            'images': images,
-            'slipways': slipways,
-            'total_hours_underwater': total_hours_underwater,
-            'users': users,
-            }
-    return Response(obj)
+    return Response(get_cached_site_statistics())